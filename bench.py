@@ -0,0 +1,774 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарки PizzaFlow.
+
+Запуск: python bench.py <имя> [параметры], список — python bench.py -h.
+Все данные синтетические и создаются во временной папке, data/ не трогается.
+"""
+import argparse, calendar, json, math, os, random, sqlite3, subprocess, sys, tempfile, threading, time
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# telegram_bot при импорте создаёт DATA_DIR — уводим его во временную папку
+os.environ.setdefault("PIZZAFLOW_DATA_DIR", tempfile.mkdtemp(prefix="pizzaflow-"))
+sys.path.insert(0, HERE)
+
+import telegram_bot as tb  # noqa: E402
+
+
+# ===== Синтетические данные =====
+# пиццерии разбросаны по прямоугольнику примерно от Калининграда до Урала
+GEO_BOX = (43.0, 62.0, 20.0, 60.0)
+# Чукотка и окрестности: прямоугольник через ±180° долготы
+ANTIMERIDIAN_BOX = (60.0, 85.0, 170.0, 190.0)
+
+
+def _wrap_lon(lon: float) -> float:
+    return (lon + 180.0) % 360.0 - 180.0
+
+
+def _utc_offset(lon: float) -> str:
+    # грубо по долготе: Калининград, Москва, Самара, Екатеринбург
+    for edge, offset in ((23.0, "+02:00"), (49.0, "+03:00"), (55.0, "+04:00")):
+        if lon < edge:
+            return offset
+    return "+05:00"
+
+
+def make_catalog(data_dir: str, n_stores: int, items_per_store: int, box=GEO_BOX):
+    rnd = random.Random(42)
+    lat_min, lat_max, lon_min, lon_max = box
+    stores, menu = [], []
+    for s in range(n_stores):
+        store_id = f"st-{s}"
+        lat = round(rnd.uniform(lat_min, lat_max), 6)
+        lon = round(_wrap_lon(rnd.uniform(lon_min, lon_max)), 6)
+        stores.append(
+            {
+                "id": store_id,
+                "name": f"Пиццерия {s}",
+                "city": f"Город {s % 50}",
+                "address": f"ул. Ленина, {s}",
+                "lat": lat,
+                "lon": lon,
+                "hours": "10:00-23:00" if s % 4 else "00:00-00:00",
+                "utc_offset": _utc_offset(lon),
+            }
+        )
+        for i in range(items_per_store):
+            menu.append(
+                {
+                    "id": f"item{i}",
+                    "name": f"Пицца {i}",
+                    "store_id": store_id,
+                    "sizes": {"S": 390 + i, "M": 490 + i, "L": 590 + i},
+                }
+            )
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(data_dir, "stores.json"), "w", encoding="utf-8") as f:
+        json.dump(stores, f, ensure_ascii=False)
+    with open(os.path.join(data_dir, "menu.json"), "w", encoding="utf-8") as f:
+        json.dump(menu, f, ensure_ascii=False)
+
+
+def timeit(fn, repeat: int = 5) -> float:
+    """Лучшее время из repeat запусков, в миллисекундах."""
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best * 1000
+
+
+# ===== Старт бота =====
+STARTUP_PROBE = """
+import time
+t0 = time.perf_counter()
+import telegram_bot as tb
+t1 = time.perf_counter()
+tb.CATALOG.menu
+t2 = time.perf_counter()
+tb.db._connect().close()
+t3 = time.perf_counter()
+print((t1 - t0) * 1000, (t2 - t1) * 1000, (t3 - t2) * 1000)
+"""
+
+
+def _probe_startup(data_dir: str):
+    env = dict(os.environ, PIZZAFLOW_DATA_DIR=data_dir)
+    out = subprocess.run(
+        [sys.executable, "-c", STARTUP_PROBE],
+        cwd=HERE,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return [float(x) for x in out.split()]
+
+
+def bench_startup(args):
+    data_dir = tempfile.mkdtemp(prefix="pizzaflow-startup-")
+    make_catalog(data_dir, args.stores, args.items)
+    print(f"каталог: {args.stores} пиццерий x {args.items} позиций")
+
+    imp, cat, schema = _probe_startup(data_dir)
+    print(f"холодный старт (нет снимка, нет БД): импорт {imp:.1f} мс, "
+          f"каталог из JSON + сборка снимка {cat:.1f} мс, схема БД {schema:.1f} мс")
+    imp, cat, schema = _probe_startup(data_dir)
+    print(f"тёплый старт (снимок есть, user_version совпал): импорт {imp:.1f} мс, "
+          f"каталог из снимка {cat:.1f} мс, схема БД {schema:.1f} мс")
+
+    catalog = tb.Catalog(
+        os.path.join(data_dir, "stores.json"),
+        os.path.join(data_dir, "menu.json"),
+        os.path.join(data_dir, "catalog.snap"),
+    )
+
+    def from_json():
+        stores = tb.load_json(catalog.stores_path)
+        menu = tb.load_json(catalog.menu_path)
+        return stores, menu
+
+    def open_snapshot():
+        fresh = tb.Catalog(catalog.stores_path, catalog.menu_path, catalog.snapshot_path)
+        fresh._load()
+        return fresh
+
+    def first_lookup():
+        fresh = open_snapshot()
+        return fresh.store("st-0"), fresh.items_of("st-0")
+
+    print(f"json.load stores+menu: {timeit(from_json):.1f} мс")
+    print(f"снимок через mmap (только оглавление): {timeit(open_snapshot):.3f} мс")
+    print(f"снимок + первый поиск пиццерии и её меню: {timeit(first_lookup):.1f} мс")
+
+
+# ===== Запись корзин =====
+def _cart_line(n: int):
+    return {
+        "item_id": f"item{n % 30}",
+        "item_name": f"Пицца {n % 30}",
+        "store_id": "st-1",
+        "size": "M",
+        "qty": 1 + n % 3,
+        "price": 490,
+    }
+
+
+def _cart_workload(db, ops: int, users: int, threads: int):
+    """Типичная смесь: /add (get+set), изредка /cancel; ops делится по потокам."""
+
+    def worker(offset: int):
+        for n in range(offset, ops, threads):
+            uid = str(n % users)
+            if n % 10 == 9:
+                db.clear_cart(uid)
+                continue
+            cart = db.get_cart(uid)
+            cart.append(_cart_line(n))
+            db.set_cart(uid, cart)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    t = time.perf_counter()
+    for th in pool:
+        th.start()
+    for th in pool:
+        th.join()
+    if isinstance(db, tb.WriteBehindDB):
+        db.flush()
+    return time.perf_counter() - t
+
+
+def bench_cart(args):
+    tmp = tempfile.mkdtemp(prefix="pizzaflow-cart-")
+    print(f"{args.ops} операций с корзиной, {args.users} пользователей, "
+          f"{args.threads} потоков")
+
+    direct = tb.DB(os.path.join(tmp, "direct.db"))
+    dt = _cart_workload(direct, args.ops, args.users, args.threads)
+    print(f"DB напрямую (commit на каждую операцию): {args.ops / dt:,.0f} оп/с")
+
+    for interval, max_ops in ((2, 64), (5, 256), (20, 1024)):
+        wb = tb.WriteBehindDB(
+            tb.DB(os.path.join(tmp, f"wb-{interval}.db")), interval, max_ops
+        )
+        dt = _cart_workload(wb, args.ops, args.users, args.threads)
+        wb.close()
+        print(f"write-behind {interval} мс / {max_ops} оп: {args.ops / dt:,.0f} оп/с")
+
+    # гонка: первые /add пользователя из разных потоков, корзины ещё нет в памяти
+    wb = tb.WriteBehindDB(tb.DB(os.path.join(tmp, "race.db")), 5, 256)
+    trials, threads, lost = 200, 8, 0
+    for trial in range(trials):
+        uid = f"race-{trial}"
+        pool = [
+            threading.Thread(target=wb.add_item, args=(uid, _cart_line(i)))
+            for i in range(threads)
+        ]
+        for th in pool:
+            th.start()
+        for th in pool:
+            th.join()
+        wb.flush()
+        lost += len(wb.get_cart(uid)) != threads
+    wb.close()
+    print(f"параллельные add_item: потеряны позиции в {lost}/{trials} попытках")
+
+
+def _cart_session(carts, ops: int, users: int):
+    """/add, затем /cart (позиции + сумма); раз в 10 шагов — /confirm-очистка."""
+    t = time.perf_counter()
+    for n in range(ops):
+        uid = str(n % users)
+        if n % 10 == 9:
+            carts.clear_cart(uid)
+            continue
+        carts.add_item(uid, _cart_line(n))
+        carts.get_cart(uid)
+        carts.cart_total(uid)
+    return time.perf_counter() - t
+
+
+def bench_carts(args):
+    tmp = tempfile.mkdtemp(prefix="pizzaflow-carts-")
+    print(f"{args.ops} шагов /add + /cart, {args.users} пользователей")
+
+    dt = _cart_session(tb.DB(os.path.join(tmp, "app.db")), args.ops, args.users)
+    print(f"cart_items в SQLite: {args.ops / dt:,.0f} шагов/с")
+
+    journal = os.path.join(tmp, "carts.journal")
+    store = tb.CartStore(journal, tb.CART_TTL, tb.CART_COMPACT_AFTER)
+    dt = _cart_session(store, args.ops, args.users)
+    print(f"CartStore (память + журнал): {args.ops / dt:,.0f} шагов/с, "
+          f"журнал {os.path.getsize(journal) / 1024:.0f} КБ")
+
+    store.close()  # иначе второй CartStore будет ждать блокировку журнала
+    t = time.perf_counter()
+    replayed = tb.CartStore(journal, tb.CART_TTL, tb.CART_COMPACT_AFTER)
+    replayed.cart_total("0")
+    print(f"проигрывание журнала при старте: {(time.perf_counter() - t) * 1000:.1f} мс, "
+          f"после сжатия {os.path.getsize(journal) / 1024:.0f} КБ")
+    replayed.close()
+
+    # первый старт после обновления: журнала нет, корзины лежат в cart_items
+    legacy = tb.DB(os.path.join(tmp, "legacy.db"))
+    for n in range(args.users):
+        legacy.add_item(str(n), _cart_line(n))
+    migrated = tb.CartStore(
+        os.path.join(tmp, "migrated.journal"), tb.CART_TTL, tb.CART_COMPACT_AFTER, legacy=legacy
+    )
+    kept = sum(len(migrated.get_cart(str(n))) for n in range(args.users))
+    migrated.close()
+    print(f"перенос из cart_items: {kept}/{args.users} позиций")
+
+
+# ===== Ближайшие пиццерии =====
+def _geo_catalog(n_stores: int, box) -> "tb.Catalog":
+    tmp = tempfile.mkdtemp(prefix="pizzaflow-geo-")
+    make_catalog(tmp, n_stores, 1, box)
+    return tb.Catalog(
+        os.path.join(tmp, "stores.json"),
+        os.path.join(tmp, "menu.json"),
+        os.path.join(tmp, "catalog.snap"),
+    )
+
+
+def _geo_points(n: int, box, seed: int = 7) -> list:
+    rnd = random.Random(seed)
+    lat_min, lat_max, lon_min, lon_max = box
+    return [
+        (rnd.uniform(lat_min, lat_max), _wrap_lon(rnd.uniform(lon_min, lon_max)))
+        for _ in range(n)
+    ]
+
+
+def _geo_compare(catalog, title: str, points: list, now: float, max_km: float):
+    """Сетка против полного перебора с теми же правилами (часы по местному времени)."""
+    data = catalog._load()
+    k = tb.NEAREST_STORES_K
+
+    def brute(lat, lon):
+        found = [
+            (d, s)
+            for d, s in (
+                (tb.haversine_km(lat, lon, *data["coords"][n]), s)
+                for n, s in enumerate(catalog.stores)
+                if tb.is_open_at(
+                    data["hours"][n], tb.local_minute(now, data["offsets"][n])
+                )
+            )
+            if d <= max_km
+        ]
+        found.sort(key=lambda p: p[0])
+        return found[:k]
+
+    t = time.perf_counter()
+    fast = [catalog.nearest_stores(lat, lon, k, now=now, max_km=max_km) for lat, lon in points]
+    grid_ms = (time.perf_counter() - t) * 1000 / len(points)
+    t = time.perf_counter()
+    slow = [brute(lat, lon) for lat, lon in points]
+    brute_ms = (time.perf_counter() - t) * 1000 / len(points)
+    mismatched = sum(
+        [s["id"] for _, s in a] != [s["id"] for _, s in b] for a, b in zip(fast, slow)
+    )
+    print(f"{title}: сетка {grid_ms:.3f} мс/запрос, полный перебор {brute_ms:.3f} мс/запрос, "
+          f"расхождений: {mismatched}/{len(points)}")
+
+
+def bench_geo(args):
+    # "00:00-00:00" — круглосуточно, "22:00-02:00" — через полночь
+    assert tb.is_open_at(tb.parse_hours("00:00-00:00"), 3 * 60)
+    assert tb.is_open_at(tb.parse_hours("22:00-02:00"), 60)
+    assert not tb.is_open_at(tb.parse_hours("10:00-23:00"), 3 * 60)
+    # часы работы — по местному времени пиццерии
+    evening = calendar.timegm((2026, 1, 1, 20, 30, 0))  # 22:30 в Калининграде, 01:30 на Урале
+    assert tb.local_minute(evening, tb.parse_utc_offset("+02:00")) == 22 * 60 + 30
+    assert tb.local_minute(evening, tb.parse_utc_offset("+05:00")) == 60 + 30
+
+    catalog = _geo_catalog(args.stores, GEO_BOX)
+    points = _geo_points(args.queries, GEO_BOX)
+    noon = calendar.timegm((2026, 1, 1, 9, 0, 0))  # 12:00 по Москве
+    night = calendar.timegm((2025, 12, 31, 23, 30, 0))  # 01:30–04:30 местного
+    far = [(43.1, 131.9)] * len(points)  # Владивосток: рядом с ним в каталоге ничего нет
+    print(f"{args.stores} пиццерий, {args.queries} запросов, k={tb.NEAREST_STORES_K}, "
+          f"сетка {catalog._load()['grid_cell']:.3f}°")
+    cases = (
+        ("днём", points, noon, tb.NEAREST_STORES_MAX_KM),
+        ("днём, без ограничения радиуса", points, noon, math.inf),
+        ("вечером (на западе ещё открыто, на Урале уже нет)", points, evening, math.inf),
+        ("ночью (открыты только круглосуточные)", points, night, tb.NEAREST_STORES_MAX_KM),
+        ("далеко от всех пиццерий", far, noon, tb.NEAREST_STORES_MAX_KM),
+        ("далеко, без ограничения радиуса", far, noon, math.inf),
+    )
+    for title, pts, now, max_km in cases:
+        _geo_compare(catalog, title, pts, now, max_km)
+
+    # пиццерии по обе стороны от ±180°, высокие широты
+    polar = _geo_catalog(300, ANTIMERIDIAN_BOX)
+    pts = _geo_points(max(args.queries, 3000), ANTIMERIDIAN_BOX, seed=11)
+    _geo_compare(polar, "через ±180°", pts, noon, tb.NEAREST_STORES_MAX_KM)
+    _geo_compare(polar, "через ±180°, без ограничения радиуса", pts, noon, math.inf)
+
+
+# ===== Нечёткий поиск по меню =====
+SYLLABLES = [
+    ("ka", "ка"), ("ro", "ро"), ("ne", "не"), ("pi", "пи"), ("tsa", "ца"),
+    ("mar", "мар"), ("ge", "ге"), ("ri", "ри"), ("ta", "та"), ("pep", "пеп"),
+    ("lo", "ло"), ("sal", "сал"), ("mi", "ми"), ("gri", "гри"), ("bo", "бо"),
+    ("chi", "чи"), ("zo", "зо"), ("va", "ва"), ("do", "до"), ("fu", "фу"),
+]
+
+
+def _typo(word: str, rnd: random.Random) -> str:
+    i = rnd.randrange(len(word))
+    kind = rnd.randrange(3)
+    if kind == 0:
+        return word[:i] + word[i + 1 :]  # пропуск буквы
+    if kind == 1:
+        return word[:i] + word[i] + word[i:]  # двойная буква
+    j = min(i + 1, len(word) - 1)
+    return word[:i] + word[j] + word[i] + word[j + 1 :]  # перестановка
+
+
+def bench_search(args):
+    rnd = random.Random(3)
+    menu, seen = [], set()
+    while len(menu) < args.menu:
+        parts = [rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))]
+        item_id = "".join(p[0] for p in parts)
+        if item_id in seen:
+            continue
+        seen.add(item_id)
+        name = "Пицца " + "".join(p[1] for p in parts).capitalize()
+        menu.append(
+            {"id": item_id, "name": name, "store_id": "st-0", "sizes": {"M": 490}}
+        )
+    tmp = tempfile.mkdtemp(prefix="pizzaflow-search-")
+    with open(os.path.join(tmp, "stores.json"), "w", encoding="utf-8") as f:
+        json.dump([{"id": "st-0", "name": "P", "city": "C", "address": "A"}], f)
+    with open(os.path.join(tmp, "menu.json"), "w", encoding="utf-8") as f:
+        json.dump(menu, f, ensure_ascii=False)
+    catalog = tb.Catalog(
+        os.path.join(tmp, "stores.json"),
+        os.path.join(tmp, "menu.json"),
+        os.path.join(tmp, "catalog.snap"),
+    )
+    catalog._load()
+
+    sample = [rnd.choice(menu) for _ in range(args.queries)]
+    queries = [
+        (_typo(it["id"], rnd) if n % 2 else _typo(it["name"].split()[1].lower(), rnd), it["id"])
+        for n, it in enumerate(sample)
+    ]
+    results = [catalog.search(q, limit=5) for q, _ in queries]
+    per_query = timeit(lambda: [catalog.search(q, limit=5) for q, _ in queries]) / len(queries)
+    top1 = sum(1 for r, (_, want) in zip(results, queries) if r and r[0][1] == want)
+    top5 = sum(1 for r, (_, want) in zip(results, queries) if want in [x[1] for x in r])
+    print(f"меню: {len(menu)} товаров, {len(queries)} запросов с опечаткой")
+    print(f"поиск по триграммам: {per_query:.3f} мс/запрос")
+    print(f"нужный товар первым: {top1 / len(queries):.0%}, в топ-5: {top5 / len(queries):.0%}")
+
+    # /add с опечаткой: find_menu_item либо берёт товар сам, либо предлагает варианты
+    saved, tb.CATALOG = tb.CATALOG, catalog
+    try:
+        picked = [tb.find_menu_item(q, "M")[0] for q, _ in queries]
+    finally:
+        tb.CATALOG = saved
+    right = sum(1 for it, (_, want) in zip(picked, queries) if it and it["id"] == want)
+    wrong = sum(1 for it, (_, want) in zip(picked, queries) if it and it["id"] != want)
+    print(f"find_menu_item: взят нужный {right}, чужой {wrong}, "
+          f"переспросили {len(queries) - right - wrong} из {len(queries)}")
+
+
+# ===== Повторная доставка апдейтов =====
+def _update(update_id: int, chat_id: int, message_id: int):
+    return SimpleNamespace(
+        update_id=update_id,
+        message=SimpleNamespace(
+            chat=SimpleNamespace(id=chat_id), message_id=message_id
+        ),
+    )
+
+
+def bench_dedup(args):
+    rnd = random.Random(11)
+    tmp = tempfile.mkdtemp(prefix="pizzaflow-dedup-")
+    hwm_path = os.path.join(tmp, "updates.hwm")
+    n = args.ops
+    stream = [_update(1000 + i, i % 97, 500 + i) for i in range(n)]
+
+    # пачки по 100, каждая пятая приходит повторно (переподключение polling),
+    # плюс отдельные повторы webhook
+    batches = [stream[i : i + 100] for i in range(0, n, 100)]
+    replayed: list = []
+    for k, batch in enumerate(batches):
+        replayed.append(batch)
+        if k % 5 == 4:
+            replayed.append(batch)
+        if rnd.random() < 0.3:
+            replayed.append([rnd.choice(batch)])
+
+    # недавнее сообщение повторно, но под другим update_id
+    resent = [
+        _update(10**7 + i, u.message.chat.id, u.message.message_id)
+        for i, u in enumerate(stream[-50:])
+    ]
+
+    dedup = tb.UpdateDeduplicator(hwm_path, tb.DEDUP_CAPACITY)
+    total = sum(len(b) for b in replayed) + len(resent)
+    t = time.perf_counter()
+    delivered = [u for batch in replayed for u in dedup.filter(batch)]
+    delivered += dedup.filter(resent)
+    dt = time.perf_counter() - t
+    dedup.persist()
+    ids = [u.update_id for u in delivered]
+    assert len(ids) == len(set(ids)) == n, (len(ids), len(set(ids)), n)
+    print(f"{total} апдейтов, из них {total - n} повторов: "
+          f"до хендлеров дошло {len(ids)}, {dt / total * 1e6:.2f} мкс/апдейт")
+
+    # рестарт: новый процесс получает последние пачки ещё раз
+    restarted = tb.UpdateDeduplicator(hwm_path, tb.DEDUP_CAPACITY)
+    again = restarted.filter(stream[-300:])
+    fresh = restarted.filter([_update(1000 + n, 1, 10**6)])
+    assert not again and len(fresh) == 1, (len(again), len(fresh))
+    print("после рестарта повторы отброшены по сохранённому update_id: OK")
+
+
+# ===== История и выгрузка заказов =====
+def _fill_orders(db, n_orders: int, users: int):
+    conn = db._connect()
+    cur = conn.cursor()
+    base = 1_700_000_000
+    step = 10_000
+    for start in range(0, n_orders, step):
+        ids = range(start, min(start + step, n_orders))
+        cur.executemany(
+            "INSERT INTO orders (id, user_id, store_id, total, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(f"{i:010d}", str(i % users), "st-1", 1080, "Confirmed", base + i) for i in ids],
+        )
+        cur.executemany(
+            "INSERT INTO order_items (order_id, item_id, item_name, size, qty, price) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (f"{i:010d}", item, name, "M", 1, price)
+                for i in ids
+                for item, name, price in (
+                    ("pepperoni", "Пепперони", 590),
+                    ("margherita", "Маргарита", 490),
+                )
+            ],
+        )
+    conn.commit()
+    conn.close()
+
+
+def _max_rss_mb() -> float:
+    try:
+        import resource  # только Unix
+    except ImportError:
+        return math.nan  # на Windows пиковый RSS не меряем
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _bench_export_file(path: str, fmt: str):
+    rss = _max_rss_mb()
+    t = time.perf_counter()
+    count = tb.export_orders(path, fmt)
+    dt = time.perf_counter() - t
+    print(f"выгрузка {os.path.basename(path)}: {count:,} заказов за {dt:.1f} с "
+          f"({count / dt:,.0f} заказов/с), файл {os.path.getsize(path) / 2**20:.1f} МБ, "
+          f"прирост пикового RSS {_max_rss_mb() - rss:.1f} МБ")
+    os.remove(path)
+
+
+def bench_export(args):
+    tmp = tempfile.mkdtemp(prefix="pizzaflow-export-")
+    tb.db = tb.DB(os.path.join(tmp, "app.db"))
+    t = time.perf_counter()
+    _fill_orders(tb.db, args.orders, args.users)
+    print(f"{args.orders:,} заказов x 2 позиции, заполнение {time.perf_counter() - t:.1f} с")
+
+    uid = "7"
+    t = time.perf_counter()
+    pages, before = 0, None
+    while pages < 50:
+        page = tb.db.list_orders(uid, tb.HISTORY_PAGE_SIZE, before)
+        if not page:
+            break
+        before = tb.decode_history_cursor(tb.encode_history_cursor(page[-1]))
+        pages += 1
+    print(f"/history: {(time.perf_counter() - t) * 1000 / pages:.3f} мс/страница")
+
+    for fmt in tb.EXPORT_FORMATS:
+        for suffix in ("", ".gz"):
+            _bench_export_file(os.path.join(tmp, f"orders.{fmt}{suffix}"), fmt)
+
+
+# ===== Онлайн-бэкапы =====
+def bench_backup(args):
+    tmp = tempfile.mkdtemp(prefix="pizzaflow-backup-")
+    db_path = os.path.join(tmp, "app.db")
+    db = tb.DB(db_path)
+    _fill_orders(db, args.orders, args.users)
+    print(f"БД: {args.orders:,} заказов, {os.path.getsize(db_path) / 2**20:.0f} МБ")
+
+    latency = tb.LatencyRecorder()
+    stop = threading.Event()
+
+    def handler(n: int):
+        # как /add по таблице cart_items + /status: запись и чтение
+        started = time.monotonic()
+        uid = str(n % args.users)
+        db.add_item(uid, _cart_line(n))
+        db.get_last_order_of(uid)
+        latency.record(started, time.monotonic() - started)
+
+    def load():
+        n = 0
+        while not stop.is_set():
+            handler(n)
+            n += 1
+            time.sleep(0.002)
+
+    worker = threading.Thread(target=load)
+    worker.start()
+    time.sleep(2)  # базовая линия задержек
+    manager = tb.BackupManager(
+        db_path, os.path.join(tmp, "backups"), 2,
+        args.pages, tb.BACKUP_STEP_SLEEP_S, latency,
+    )
+    report = manager.backup()
+    stop.set()
+    worker.join()
+    print(f"бэкап: {report['seconds']} с, {report['steps']} шагов по {args.pages} страниц, "
+          f"снимок WAL: {report['wal_snapshot']}")
+    for key in ("latency_before", "latency_during"):
+        s = report[key]
+        print(f"{key}: n={s['n']} p50={s['p50']} мс p95={s['p95']} мс max={s['max']} мс")
+
+    manager.backup()  # дописанное во время первого бэкапа
+    print(f"без изменений повторный бэкап пропущен: {manager.backup() is None}")
+    # /backup: бэкап снимает поток менеджера, отчёт приходит в колбэк
+    got = {}
+    ready = threading.Event()
+    t = time.perf_counter()
+    manager.request(lambda report, error: (got.update(report=report, error=error), ready.set()))
+    queued_ms = (time.perf_counter() - t) * 1000
+    ready.wait()
+    last = got["report"]
+    print(f"внеочередной бэкап: хендлер занят {queued_ms:.3f} мс, "
+          f"отчёт через {time.perf_counter() - t:.1f} с, ошибка: {got['error']}")
+    print(f"хранится файлов в backups/ (keep=2): {len(os.listdir(os.path.join(tmp, 'backups')))}")
+
+    restored = os.path.join(tmp, "restored.db")
+    tb.restore_backup(last["path"], restored)
+    print(f"восстановление проверено: {tb.verify_backup(restored)}")
+    conn = sqlite3.connect(restored)
+    print(f"режим журнала восстановленной БД: {conn.execute('PRAGMA journal_mode').fetchone()[0]}")
+    conn.close()
+
+
+# ===== Заказ кнопками против текстовых команд =====
+class _CountingBot:
+    """Подменяет бота в хендлерах и считает вызовы Telegram API."""
+
+    def __init__(self):
+        self.sent = 0
+        self.edits = 0
+        self.answers = 0
+        self.markup = None
+
+    def reply_to(self, m, text, reply_markup=None, **kwargs):
+        self.sent += 1
+        self.markup = reply_markup or self.markup
+
+    def edit_message_text(self, text, chat_id, message_id, reply_markup=None, **kwargs):
+        self.edits += 1
+        self.markup = reply_markup or self.markup
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.answers += 1
+
+
+def _user(uid: int):
+    return SimpleNamespace(id=uid, username="", first_name="")
+
+
+def _message(uid: int, text: str):
+    return SimpleNamespace(
+        text=text, from_user=_user(uid), chat=SimpleNamespace(id=uid), message_id=1
+    )
+
+
+def _callback(uid: int, data: str):
+    return SimpleNamespace(
+        id="q", data=data, from_user=_user(uid),
+        message=SimpleNamespace(chat=SimpleNamespace(id=uid), message_id=1),
+    )
+
+
+def _button(markup, prefix: str) -> str:
+    return next(
+        b.callback_data
+        for row in markup.keyboard
+        for b in row
+        if b.callback_data.startswith(prefix)
+    )
+
+
+def bench_inline(args):
+    # свой каталог, БД и корзины во временном каталоге — данные бота не трогаем
+    tmp = tempfile.mkdtemp(prefix="pizzaflow-inline-")
+    make_catalog(tmp, 60, 8)
+    tb.CATALOG = tb.Catalog(
+        os.path.join(tmp, "stores.json"),
+        os.path.join(tmp, "menu.json"),
+        os.path.join(tmp, "catalog.snap"),
+    )
+    tb.keyboards = tb.KeyboardCache(tb.CATALOG)
+    tb.db = tb.DB(os.path.join(tmp, "app.db"))
+    tb.carts = tb.CartStore(
+        os.path.join(tmp, "carts.journal"), tb.CART_TTL, tb.CART_COMPACT_AFTER
+    )
+    counting = tb.bot = _CountingBot()
+    print("позиций | апдейтов (текст / кнопки) | сообщений от клиента | сообщений от бота")
+    for n_items in (1, 2, 3):
+        counting.__init__()
+        uid = 100 + n_items
+        script = [(tb.cmd_stores, "/stores"), (tb.cmd_menu, "/menu st-0")]
+        script += [(tb.cmd_add, f"/add item{i} M 1") for i in range(n_items)]
+        for handler, text in script:
+            handler(_message(uid, text))
+        tb.cmd_confirm(_message(uid, "/confirm st-0"))
+        tb.cmd_pay(_message(uid, "/pay"))
+        updates = len(script) + 2
+        text_flow = (updates, updates, counting.sent)
+
+        counting.__init__()
+        uid += 1000
+        tb.cmd_order(_message(uid, "/order"))
+        tb.cb_order(_callback(uid, _button(counting.markup, "s|")))
+        menu = counting.markup
+        item_buttons = [
+            b.callback_data for row in menu.keyboard for b in row
+            if b.callback_data.startswith("a|") and b.callback_data.endswith("|M")
+        ]
+        for data in item_buttons[:n_items]:
+            tb.cb_order(_callback(uid, data))
+        tb.cb_order(_callback(uid, _button(menu, "c|")))
+        updates = 3 + n_items
+        assert tb.db.get_last_order_of(str(uid))["status"] == "Confirmed"
+        inline_flow = (updates, 1, counting.sent)
+        print(f"{n_items:7} | {text_flow[0]:>10} / {inline_flow[0]:<12} | "
+              f"{text_flow[1]:>9} / {inline_flow[1]:<8} | "
+              f"{text_flow[2]:>7} / {inline_flow[2]} (+{counting.edits} правок)")
+
+    # адреса, которых нет в каталоге, делят одну закэшированную клавиатуру
+    for n in range(1000):
+        tb.keyboards.stores(f"Деревня {n}")
+    city_kb = tb.keyboards.stores("Город 7")
+    any_kb = tb.keyboards.stores("Деревня 0")
+    print(f"клавиатур пиццерий в кэше после 1000 чужих адресов: {len(tb.keyboards._cache)}, "
+          f"кнопок для своего города: {len(city_kb.keyboard)}, "
+          f"для чужого: {len(any_kb.keyboard)} из {len(tb.CATALOG.stores)}")
+
+    # два заказа кнопками подряд, в одну секунду
+    ids = []
+    for uid in (5001, 5002):
+        tb.cmd_order(_message(uid, "/order"))
+        tb.cb_order(_callback(uid, _button(counting.markup, "s|")))
+        tb.cb_order(_callback(uid, _button(counting.markup, "a|")))
+        tb.cb_order(_callback(uid, _button(counting.markup, "c|")))
+        ids.append(tb.db.get_last_order_of(str(uid))["id"])
+    print(f"заказы в одну секунду: {ids}")
+
+    # город не распознан: геопозиция → кнопки ближайших → меню
+    counting.__init__()
+    store = tb.CATALOG.stores[0]
+    here = _message(6001, "")
+    here.location = SimpleNamespace(latitude=store["lat"], longitude=store["lon"])
+    tb.cmd_location(here)
+    tb.cb_order(_callback(6001, _button(counting.markup, "s|")))
+    print(f"геопозиция → меню пиццерии: {counting.sent} сообщение, {counting.edits} правка, "
+          f"кнопок позиций {len(counting.markup.keyboard) - 2}")
+
+    build_ms = timeit(lambda: tb.build_menu_keyboard(tb.CATALOG.version, "st-0"), 50)
+    cached_ms = timeit(lambda: tb.keyboards.menu("st-0"), 50)
+    print(f"клавиатура меню: сборка {build_ms * 1000:.0f} мкс, из кэша {cached_ms * 1000:.1f} мкс")
+
+
+BENCHES = {
+    "cart": bench_cart,
+    "carts": bench_carts,
+    "backup": bench_backup,
+    "dedup": bench_dedup,
+    "export": bench_export,
+    "geo": bench_geo,
+    "inline": bench_inline,
+    "search": bench_search,
+    "startup": bench_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки PizzaFlow")
+    parser.add_argument("name", choices=sorted(BENCHES))
+    parser.add_argument("--stores", type=int, default=2000)
+    parser.add_argument("--items", type=int, default=30)
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--menu", type=int, default=5000)
+    parser.add_argument("--orders", type=int, default=2_000_000)
+    parser.add_argument("--pages", type=int, default=tb.BACKUP_PAGES_PER_STEP)
+    args = parser.parse_args()
+    BENCHES[args.name](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
-from telebot import TeleBot, types
-import json, os, time, sqlite3
-from typing import Dict, Any, List
+import os, sys, json, time, sqlite3, marshal, mmap, struct, hashlib, threading, atexit, math, heapq
+import csv, functools, gzip
+from collections import Counter, OrderedDict, deque
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import fcntl  # блокировка журнала корзин; на Windows её нет
+except ImportError:
+    fcntl = None
+
+# telebot (и тянущийся за ним requests) импортируется лениво — см. LazyBot
 
 # ===== Конфиг =====
 try:
@@ -32,27 +40,50 @@ class MockPaymentProvider:
         }
 
 
-DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+DATA_DIR = os.getenv(
+    "PIZZAFLOW_DATA_DIR", os.path.join(os.path.dirname(__file__), "data")
+)
 DB_PATH = os.path.join(DATA_DIR, "app.db")  # теперь SQLite-файл, раньше был db.json
 STORES_PATH = os.path.join(DATA_DIR, "stores.json")
 MENU_PATH = os.path.join(DATA_DIR, "menu.json")
+# скомпилированный снимок каталога (stores.json + menu.json + индексы)
+CATALOG_SNAPSHOT_PATH = os.path.join(DATA_DIR, "catalog.snap")
 
 os.makedirs(DATA_DIR, exist_ok=True)
 
 
 # ===== БД на SQLite вместо JSON =====
+# версия схемы хранится в PRAGMA user_version; при совпадении
+# CREATE TABLE на старте не выполняются
+SCHEMA_VERSION = 3
+
+
 class DB:
     def __init__(self, path: str):
         self.path = path
-        self._init_db()
+        # схема проверяется лениво, при первом подключении
+        self._ready = False
 
     def _connect(self):
+        if not self._ready:
+            self._init_db()
+            self._ready = True
         return sqlite3.connect(self.path)
 
     def _init_db(self):
-        conn = self._connect()
+        conn = sqlite3.connect(self.path)
         cur = conn.cursor()
 
+        # WAL: читатели (в том числе онлайн-бэкап) не блокируют писателей;
+        # режим хранится в файле БД, но проверяем его до сверки версии —
+        # восстановленная из бэкапа БД приходит в режиме DELETE
+        cur.execute("PRAGMA journal_mode = WAL")
+
+        cur.execute("PRAGMA user_version")
+        if cur.fetchone()[0] == SCHEMA_VERSION:
+            conn.close()
+            return
+
         # таблица пользователей
         cur.execute(
             """
@@ -112,6 +143,16 @@ class DB:
         """
         )
 
+        # индексы для /history (keyset по created_at) и выгрузки заказов с позициями
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_orders_user_created "
+            "ON orders (user_id, created_at, id)"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)"
+        )
+
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         conn.commit()
         conn.close()
 
@@ -192,30 +233,93 @@ class DB:
             )
         return cart
 
+    def get_all_carts(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Все корзины из cart_items (для переноса в CartStore)."""
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT user_id, item_id, item_name, store_id, size, qty, price "
+            "FROM cart_items ORDER BY id"
+        )
+        rows = cur.fetchall()
+        conn.close()
+        carts: Dict[str, List[Dict[str, Any]]] = {}
+        for uid, item_id, item_name, store_id, size, qty, price in rows:
+            carts.setdefault(uid, []).append(
+                {
+                    "item_id": item_id,
+                    "item_name": item_name,
+                    "store_id": store_id,
+                    "size": size,
+                    "qty": qty,
+                    "price": price,
+                }
+            )
+        return carts
+
     def set_cart(self, uid: str, items: List[Dict[str, Any]]):
+        self.set_carts({uid: items})
+
+    def set_carts(self, carts: Dict[str, List[Dict[str, Any]]]):
+        """Перезаписывает корзины нескольких пользователей одной транзакцией."""
         conn = self._connect()
         cur = conn.cursor()
-        # очищаем корзину пользователя и записываем заново
-        cur.execute("DELETE FROM cart_items WHERE user_id = ?", (uid,))
-        for it in items:
-            cur.execute(
+        for uid, items in carts.items():
+            # очищаем корзину пользователя и записываем заново
+            cur.execute("DELETE FROM cart_items WHERE user_id = ?", (uid,))
+            cur.executemany(
                 """
                 INSERT INTO cart_items (user_id, item_id, item_name, store_id, size, qty, price)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
                 """,
-                (
-                    uid,
-                    it.get("item_id"),
-                    it.get("item_name"),
-                    it.get("store_id"),
-                    it.get("size"),
-                    it.get("qty"),
-                    it.get("price"),
-                ),
+                [
+                    (
+                        uid,
+                        it.get("item_id"),
+                        it.get("item_name"),
+                        it.get("store_id"),
+                        it.get("size"),
+                        it.get("qty"),
+                        it.get("price"),
+                    )
+                    for it in items
+                ],
             )
         conn.commit()
         conn.close()
 
+    def add_item(self, uid: str, it: Dict[str, Any]):
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO cart_items (user_id, item_id, item_name, store_id, size, qty, price)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                uid,
+                it.get("item_id"),
+                it.get("item_name"),
+                it.get("store_id"),
+                it.get("size"),
+                it.get("qty"),
+                it.get("price"),
+            ),
+        )
+        conn.commit()
+        conn.close()
+
+    def cart_total(self, uid: str) -> int:
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT COALESCE(SUM(price * qty), 0) FROM cart_items WHERE user_id = ?",
+            (uid,),
+        )
+        total = cur.fetchone()[0]
+        conn.close()
+        return total
+
     def clear_cart(self, uid: str):
         conn = self._connect()
         cur = conn.cursor()
@@ -227,39 +331,48 @@ class DB:
     def create_order(
         self, uid: str, store_id: str, items: List[Dict[str, Any]], total: int
     ) -> str:
-        order_id = str(int(time.time()))
         created_at = int(time.time())
         conn = self._connect()
         cur = conn.cursor()
+        try:
+            # создаём заказ; номер — секунда создания, а если в эту секунду
+            # заказ уже был, добавляем суффикс: 1767225600-2, -3, ...
+            order_id = str(created_at)
+            attempt = 1
+            while True:
+                try:
+                    cur.execute(
+                        """
+                        INSERT INTO orders (id, user_id, store_id, total, status, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        (order_id, uid, store_id, total, "Pending", created_at),
+                    )
+                    break
+                except sqlite3.IntegrityError:
+                    attempt += 1
+                    order_id = f"{created_at}-{attempt}"
+
+            # сохраняем позиции заказа
+            for it in items:
+                cur.execute(
+                    """
+                    INSERT INTO order_items (order_id, item_id, item_name, size, qty, price)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        order_id,
+                        it.get("item_id"),
+                        it.get("item_name"),
+                        it.get("size"),
+                        it.get("qty"),
+                        it.get("price"),
+                    ),
+                )
 
-        # создаём заказ
-        cur.execute(
-            """
-            INSERT INTO orders (id, user_id, store_id, total, status, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (order_id, uid, store_id, total, "Pending", created_at),
-        )
-
-        # сохраняем позиции заказа
-        for it in items:
-            cur.execute(
-                """
-                INSERT INTO order_items (order_id, item_id, item_name, size, qty, price)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    order_id,
-                    it.get("item_id"),
-                    it.get("item_name"),
-                    it.get("size"),
-                    it.get("qty"),
-                    it.get("price"),
-                ),
-            )
-
-        conn.commit()
-        conn.close()
+            conn.commit()
+        finally:
+            conn.close()
         return order_id
 
     def get_order(self, order_id: str) -> Dict[str, Any]:
@@ -286,10 +399,8 @@ class DB:
             "SELECT item_id, item_name, size, qty, price FROM order_items WHERE order_id = ?",
             (order_id,),
         )
-        items_rows = cur.fetchall()
-        conn.close()
         items = []
-        for item_id, item_name, size, qty, price in items_rows:
+        for item_id, item_name, size, qty, price in cur:
             items.append(
                 {
                     "item_id": item_id,
@@ -299,6 +410,7 @@ class DB:
                     "price": price,
                 }
             )
+        conn.close()
         order["items"] = items
         return order
 
@@ -323,6 +435,97 @@ class DB:
             "created_at": row[5],
         }
 
+    def list_orders(
+        self, uid: str, limit: int, before: Optional[Tuple[int, str]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Заказы пользователя от новых к старым, страница из limit штук.
+        before — (created_at, id) последнего заказа предыдущей страницы (keyset).
+        """
+        conn = self._connect()
+        cur = conn.cursor()
+        if before is None:
+            cur.execute(
+                "SELECT id, user_id, store_id, total, status, created_at FROM orders "
+                "WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?",
+                (uid, limit),
+            )
+        else:
+            cur.execute(
+                "SELECT id, user_id, store_id, total, status, created_at FROM orders "
+                "WHERE user_id = ? AND (created_at, id) < (?, ?) "
+                "ORDER BY created_at DESC, id DESC LIMIT ?",
+                (uid, before[0], before[1], limit),
+            )
+        orders = [
+            {
+                "id": row[0],
+                "user_id": row[1],
+                "store_id": row[2],
+                "total": row[3],
+                "status": row[4],
+                "created_at": row[5],
+            }
+            for row in cur
+        ]
+        conn.close()
+        return orders
+
+    def iter_orders_with_items(self, chunk: int = 1000):
+        """
+        Генератор всех заказов (с позициями "items") в порядке id.
+        Читает пачками по chunk заказов, каждая пачка — короткий отдельный
+        запрос, так что память не зависит от размера таблиц, а писатели
+        не ждут окончания всей выгрузки.
+        """
+        last_id = ""
+        while True:
+            conn = self._connect()
+            cur = conn.cursor()
+            cur.execute(
+                """
+                WITH page AS (
+                    SELECT id, user_id, store_id, total, status, created_at
+                    FROM orders WHERE id > ? ORDER BY id LIMIT ?
+                )
+                SELECT p.id, p.user_id, p.store_id, p.total, p.status, p.created_at,
+                       i.item_id, i.item_name, i.size, i.qty, i.price
+                FROM page p LEFT JOIN order_items i ON i.order_id = p.id
+                ORDER BY p.id, i.id
+                """,
+                (last_id, chunk),
+            )
+            rows = cur.fetchall()
+            conn.close()
+            if not rows:
+                return
+            order: Dict[str, Any] = {}
+            for row in rows:
+                if row[0] != order.get("id"):
+                    if order:
+                        yield order
+                    order = {
+                        "id": row[0],
+                        "user_id": row[1],
+                        "store_id": row[2],
+                        "total": row[3],
+                        "status": row[4],
+                        "created_at": row[5],
+                        "items": [],
+                    }
+                if row[6] is not None:
+                    order["items"].append(
+                        {
+                            "item_id": row[6],
+                            "item_name": row[7],
+                            "size": row[8],
+                            "qty": row[9],
+                            "price": row[10],
+                        }
+                    )
+            yield order
+            last_id = order["id"]
+
     def set_order_status(self, order_id: str, status: str):
         conn = self._connect()
         cur = conn.cursor()
@@ -331,20 +534,1499 @@ class DB:
         conn.close()
 
 
+# ===== Отложенная запись корзин (write-behind) =====
+# включается PIZZAFLOW_CART_WRITE_BEHIND=1; границы потерь при падении —
+# не больше CART_FLUSH_MAX_OPS операций и не дольше CART_FLUSH_INTERVAL_MS
+CART_WRITE_BEHIND = os.getenv("PIZZAFLOW_CART_WRITE_BEHIND", "0") == "1"
+CART_FLUSH_INTERVAL_MS = int(os.getenv("PIZZAFLOW_CART_FLUSH_MS", "5"))
+CART_FLUSH_MAX_OPS = int(os.getenv("PIZZAFLOW_CART_FLUSH_OPS", "256"))
+
+
+class WriteBehindDB:
+    """
+    Прослойка перед методами корзины DB.
+    set_cart / clear_cart только запоминают новое состояние корзины в памяти,
+    фоновый поток сбрасывает накопленное одной транзакцией (group commit).
+    get_cart сначала смотрит в несброшенные изменения — пользователь всегда
+    видит свои записи. create_order предварительно сбрасывает всё.
+    Остальные методы прозрачно уходят в DB.
+    """
+
+    def __init__(self, db: DB, flush_interval_ms: int, max_ops: int):
+        self._db = db
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_ops = max_ops
+        # uid -> итоговая корзина ([] — очистить); повторные записи схлопываются
+        self._pending: Dict[str, List[Dict[str, Any]]] = {}
+        # пачка, которая прямо сейчас пишется в SQLite
+        self._flushing: Dict[str, List[Dict[str, Any]]] = {}
+        self._ops = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        atexit.register(self.close)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="cart-write-behind", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"cart write-behind: flush failed, retrying: {e}")
+
+    def _count_op(self) -> bool:
+        # вызывается под self._lock; True — пора сбрасывать, не дожидаясь таймера
+        self._ops += 1
+        return self._ops >= self.max_ops
+
+    def _kick(self, full: bool):
+        self._start()
+        if full:
+            self._wake.set()
+
+    def _put(self, uid: str, items: List[Dict[str, Any]]):
+        with self._lock:
+            self._pending[uid] = items
+            full = self._count_op()
+        self._kick(full)
+
+    def _append_pending(self, uid: str, it: Dict[str, Any]) -> Optional[bool]:
+        # под self._lock: дописывает позицию к несброшенной корзине;
+        # None — несброшенной корзины нет
+        items = self._pending.get(uid)
+        if items is None:
+            items = self._flushing.get(uid)
+        if items is None:
+            return None
+        self._pending[uid] = items + [it]
+        return self._count_op()
+
+    def flush(self):
+        """Синхронно записывает все накопленные изменения корзин."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+                self._ops = 0
+            try:
+                self._db.set_carts(self._flushing)
+            except sqlite3.Error:
+                # не теряем пачку: вернём то, что не перезаписано новыми операциями
+                with self._lock:
+                    for uid, items in self._flushing.items():
+                        self._pending.setdefault(uid, items)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def close(self):
+        self._stopped = True
+        self._wake.set()
+        self.flush()
+
+    # --- Cart ---
+    def get_cart(self, uid: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = self._pending.get(uid)
+            if items is None:
+                items = self._flushing.get(uid)
+            if items is not None:
+                return [dict(it) for it in items]
+        return self._db.get_cart(uid)
+
+    def set_cart(self, uid: str, items: List[Dict[str, Any]]):
+        self._put(uid, [dict(it) for it in items])
+
+    def add_item(self, uid: str, it: Dict[str, Any]):
+        it = dict(it)
+        with self._lock:
+            full = self._append_pending(uid, it)
+        if full is None:
+            # корзины нет в памяти — читаем её из SQLite. Под _flush_lock сброс
+            # не поменяет её между чтением и постановкой в очередь, а повторная
+            # проверка ловит set_cart/add_item, успевшие за это время.
+            with self._flush_lock:
+                stored = self._db.get_cart(uid)
+                with self._lock:
+                    full = self._append_pending(uid, it)
+                    if full is None:
+                        self._pending[uid] = stored + [it]
+                        full = self._count_op()
+        self._kick(full)
+
+    def cart_total(self, uid: str) -> int:
+        return sum(p["price"] * p["qty"] for p in self.get_cart(uid))
+
+    def clear_cart(self, uid: str):
+        self._put(uid, [])
+
+    # --- Orders ---
+    def create_order(
+        self, uid: str, store_id: str, items: List[Dict[str, Any]], total: int
+    ) -> str:
+        self.flush()
+        return self._db.create_order(uid, store_id, items, total)
+
+
+# ===== Корзины в памяти + журнал =====
+# PIZZAFLOW_CART_BACKEND=memory (по умолчанию) — CartStore ниже; при первом
+# старте без журнала в него переносятся корзины из cart_items.
+# sqlite — старые таблицы cart_items; только для него действует write-behind.
+CART_BACKEND = os.getenv("PIZZAFLOW_CART_BACKEND", "memory")
+CART_JOURNAL_PATH = os.path.join(DATA_DIR, "carts.journal")
+# брошенные корзины живут столько секунд с последнего изменения
+CART_TTL = int(os.getenv("PIZZAFLOW_CART_TTL", str(24 * 3600)))
+# журнал сжимается, когда в нём столько записей и вдвое больше, чем живых позиций
+CART_COMPACT_AFTER = int(os.getenv("PIZZAFLOW_CART_COMPACT_AFTER", "10000"))
+
+
+class CartLine:
+    __slots__ = ("item_id", "item_name", "store_id", "size", "qty", "price")
+
+    def __init__(self, item_id, item_name, store_id, size, qty, price):
+        self.item_id = item_id
+        self.item_name = item_name
+        self.store_id = store_id
+        self.size = size
+        self.qty = qty
+        self.price = price
+
+    @classmethod
+    def from_dict(cls, it: Dict[str, Any]) -> "CartLine":
+        return cls(
+            it.get("item_id"),
+            it.get("item_name"),
+            it.get("store_id"),
+            it.get("size"),
+            it.get("qty"),
+            it.get("price"),
+        )
+
+    def as_row(self) -> list:
+        return [self.item_id, self.item_name, self.store_id, self.size, self.qty, self.price]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "item_id": self.item_id,
+            "item_name": self.item_name,
+            "store_id": self.store_id,
+            "size": self.size,
+            "qty": self.qty,
+            "price": self.price,
+        }
+
+
+class Cart:
+    __slots__ = ("lines", "total", "touched")
+
+    def __init__(self, touched: float):
+        self.lines: List[CartLine] = []
+        self.total = 0
+        self.touched = touched
+
+    def add(self, line: CartLine):
+        self.lines.append(line)
+        self.total += line.price * line.qty
+
+
+class CartStore:
+    """
+    Активные корзины в памяти: компактные записи и готовая сумма.
+    Каждое изменение дописывается строкой в журнал (append-only),
+    при старте журнал проигрывается заново, а по мере роста — сжимается
+    до одной записи на живую корзину. Корзины старше ttl выбрасываются.
+    Журналом владеет один процесс: до проигрывания берётся flock на
+    journal_path + ".lock", и при перекрывающемся перезапуске новый процесс
+    ждёт, пока старый допишет своё и завершится.
+    Если журнала ещё нет, корзины переносятся из legacy (DB с cart_items).
+    Интерфейс совпадает с методами корзины DB.
+    """
+
+    def __init__(
+        self, journal_path: str, ttl: int, compact_after: int, legacy: Optional["DB"] = None
+    ):
+        self.journal_path = journal_path
+        self.ttl = ttl
+        self.compact_after = compact_after
+        self.legacy = legacy
+        self._carts: Dict[str, Cart] = {}
+        self._lock = threading.Lock()
+        self._journal = None  # открывается лениво, после проигрывания
+        self._journal_lock = None
+        self._records = 0
+        self._live_lines = 0
+
+    # --- Журнал ---
+    def _acquire(self):
+        self._journal_lock = open(self.journal_path + ".lock", "a")
+        if fcntl is None:
+            return  # без fcntl (Windows) — надеемся на один процесс
+        try:
+            fcntl.flock(self._journal_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("cart journal is locked by another process, waiting...")
+            fcntl.flock(self._journal_lock, fcntl.LOCK_EX)
+
+    def _import_legacy(self):
+        now = time.time()
+        for uid, items in self.legacy.get_all_carts().items():
+            cart = self._carts[uid] = Cart(now)
+            for it in items:
+                cart.add(CartLine.from_dict(it))
+        if self._carts:
+            print(f"cart journal: imported {len(self._carts)} carts from cart_items")
+
+    def _replay(self):
+        try:
+            f = open(self.journal_path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            if self.legacy is not None:
+                self._import_legacy()
+            return
+        with f:
+            for raw in f:
+                try:
+                    op, ts, uid, *rest = json.loads(raw)
+                except ValueError:
+                    continue  # недописанная строка после падения
+                if op == "C":
+                    self._carts.pop(uid, None)
+                    continue
+                cart = self._carts.get(uid)
+                if op == "S" or cart is None:
+                    cart = self._carts[uid] = Cart(ts)
+                rows = rest[0] if op == "S" else [rest]
+                for row in rows:
+                    cart.add(CartLine(*row))
+                cart.touched = ts
+
+    def _open(self):
+        if self._journal is None:
+            self._acquire()
+            self._replay()
+            # журнал после старта всегда сжимается: заодно отпадают протухшие
+            self._compact()
+
+    def _write(self, *record):
+        self._journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        self._records += 1
+        if self._records > self.compact_after and self._records > 2 * self._live_lines:
+            self._compact()
+
+    def _compact(self):
+        self._expire(time.time())
+        if self._journal is not None:
+            self._journal.close()
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for uid, cart in self._carts.items():
+                rows = [line.as_row() for line in cart.lines]
+                f.write(json.dumps(["S", cart.touched, uid, rows], ensure_ascii=False) + "\n")
+        os.replace(tmp, self.journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._records = len(self._carts)
+        self._live_lines = sum(len(c.lines) for c in self._carts.values())
+
+    def _expire(self, now: float):
+        dead = [uid for uid, c in self._carts.items() if now - c.touched > self.ttl]
+        for uid in dead:
+            del self._carts[uid]
+
+    def _cart(self, uid: str, now: float) -> Optional[Cart]:
+        cart = self._carts.get(uid)
+        if cart is not None and now - cart.touched > self.ttl:
+            del self._carts[uid]
+            self._live_lines -= len(cart.lines)
+            self._write("C", now, uid)
+            return None
+        return cart
+
+    def compact(self):
+        with self._lock:
+            self._open()
+            self._compact()
+
+    def close(self):
+        """Закрывает журнал и отпускает блокировку (следующий _open проиграет его заново)."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if self._journal_lock is not None:
+                self._journal_lock.close()  # закрытие снимает flock
+                self._journal_lock = None
+            self._carts.clear()
+
+    # --- Cart ---
+    def get_cart(self, uid: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._open()
+            cart = self._cart(uid, time.time())
+            return [line.as_dict() for line in cart.lines] if cart else []
+
+    def cart_total(self, uid: str) -> int:
+        with self._lock:
+            self._open()
+            cart = self._cart(uid, time.time())
+            return cart.total if cart else 0
+
+    def add_item(self, uid: str, it: Dict[str, Any]):
+        line = CartLine.from_dict(it)
+        with self._lock:
+            self._open()
+            now = time.time()
+            cart = self._cart(uid, now)
+            if cart is None:
+                cart = self._carts[uid] = Cart(now)
+            cart.add(line)
+            cart.touched = now
+            self._live_lines += 1
+            self._write("A", now, uid, *line.as_row())
+
+    def set_cart(self, uid: str, items: List[Dict[str, Any]]):
+        with self._lock:
+            self._open()
+            now = time.time()
+            old = self._carts.pop(uid, None)
+            if old is not None:
+                self._live_lines -= len(old.lines)
+            if not items:
+                self._write("C", now, uid)
+                return
+            cart = self._carts[uid] = Cart(now)
+            for it in items:
+                cart.add(CartLine.from_dict(it))
+            self._live_lines += len(cart.lines)
+            self._write("S", now, uid, [line.as_row() for line in cart.lines])
+
+    def clear_cart(self, uid: str):
+        self.set_cart(uid, [])
+
+
 # ===== Утилиты =====
 def load_json(path):
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
-def find_store(store_id: str, stores: list):
-    return next((s for s in stores if s["id"] == store_id), None)
-
-
 def format_rub(v: int) -> str:
     return f"{v} ₽"
 
 
+# ===== Гео: ближайшие пиццерии =====
+# у пиццерий в stores.json есть "lat", "lon" и необязательные "hours": "10:00-23:00"
+# (без hours или "00:00-00:00" — круглосуточно) и "utc_offset": "+05:00" — часы
+# работы по местному времени пиццерии; без utc_offset — по времени сервера.
+# Индекс — равномерная сетка, размер клетки подбирается при сборке снимка:
+# в среднем ~1 пиццерия на клетку. Круглосуточные пиццерии дополнительно лежат
+# в своей сетке — ночью ищем только в ней. Сетка не замкнута по долготе, поэтому
+# у ±180° поиск повторяется для точки, сдвинутой на ∓360°.
+GRID_MIN_CELL_DEG = 0.01  # ~1,1 км по широте
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEG = math.pi * EARTH_RADIUS_KM / 180
+NEAREST_STORES_K = 5
+NEAREST_STORES_MAX_KM = 50.0  # дальше не ищем: такая пиццерия всё равно не доставит
+
+
+def grid_cell(lat: float, lon: float, cell: float) -> Tuple[int, int]:
+    return math.floor(lat / cell), math.floor(lon / cell)
+
+
+def grid_cell_size(coords: List[Tuple[float, float]]) -> float:
+    if len(coords) < 2:
+        return 1.0
+    lats = [c[0] for c in coords]
+    lons = [c[1] for c in coords]
+    area = (max(lats) - min(lats)) * (max(lons) - min(lons))
+    return max(GRID_MIN_CELL_DEG, math.sqrt(area / len(coords)))
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    h = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(h)))
+
+
+def parse_hours(hours) -> Optional[Tuple[int, int]]:
+    """'10:00-23:00' -> (600, 1380) в минутах от полуночи; пусто — круглосуточно."""
+    if not hours:
+        return None
+    start, end = hours.split("-")
+    h1, m1 = start.strip().split(":")
+    h2, m2 = end.strip().split(":")
+    return int(h1) * 60 + int(m1), int(h2) * 60 + int(m2)
+
+
+def parse_utc_offset(offset) -> Optional[int]:
+    """'+05:00' -> 300, '-03:30' -> -210 минут; пусто — часовой пояс сервера."""
+    if not offset:
+        return None
+    offset = offset.strip()
+    sign = -1 if offset.startswith("-") else 1
+    h, m = offset.lstrip("+-").split(":")
+    return sign * (int(h) * 60 + int(m))
+
+
+def local_minute(now: float, offset: Optional[int]) -> int:
+    """Минута от полуночи в момент now в поясе UTC+offset (None — пояс сервера)."""
+    if offset is None:
+        t = time.localtime(now)
+        return t.tm_hour * 60 + t.tm_min
+    return (int(now // 60) + offset) % (24 * 60)
+
+
+def is_always_open(hours: Optional[Tuple[int, int]]) -> bool:
+    return hours is None or hours[0] == hours[1]  # "00:00-00:00" — круглосуточно
+
+
+def is_open_at(hours: Optional[Tuple[int, int]], minute: int) -> bool:
+    if is_always_open(hours):
+        return True
+    start, end = hours
+    if start < end:
+        return start <= minute < end
+    return minute >= start or minute < end  # работает после полуночи
+
+
+def grid_bbox(grid: Dict[Tuple[int, int], List[int]]) -> Optional[Tuple[int, int, int, int]]:
+    """(x_min, x_max, y_min, y_max) занятых клеток; None для пустой сетки."""
+    if not grid:
+        return None
+    xs = [x for x, _ in grid]
+    ys = [y for _, y in grid]
+    return min(xs), max(xs), min(ys), max(ys)
+
+
+def _grid_ring(cx: int, cy: int, r: int, bbox: Tuple[int, int, int, int]):
+    """Клетки на расстоянии ровно r (по Чебышёву) от (cx, cy), попавшие в bbox."""
+    x0, x1, y0, y1 = bbox
+    xs = range(max(cx - r, x0), min(cx + r, x1) + 1)
+    for y in (cy - r, cy + r) if r else (cy,):
+        if y0 <= y <= y1:
+            for x in xs:
+                yield x, y
+    ys = range(max(cy - r + 1, y0), min(cy + r - 1, y1) + 1)
+    for x in (cx - r, cx + r) if r else ():
+        if x0 <= x <= x1:
+            for y in ys:
+                yield x, y
+
+
+# ===== Нечёткий поиск по меню =====
+# триграммы по словам item_id и названия (кириллица и латиница),
+# сходство — коэффициент Дайса между наборами триграмм
+FUZZY_MIN_SCORE = 0.45
+# опечатку исправляем молча, только если лучший вариант заметно впереди второго
+FUZZY_MIN_MARGIN = 0.15
+FIND_LIMIT = 10
+
+
+def normalize_text(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    return " ".join("".join(ch if ch.isalnum() else " " for ch in text).split())
+
+
+def trigrams(text: str) -> set:
+    result = set()
+    for word in normalize_text(text).split():
+        padded = f"  {word} "
+        result.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def _build_search(menu: list) -> Dict[str, Any]:
+    # ключ поиска — отдельно item_id и отдельно название каждого товара
+    entries: List[Tuple[str, str]] = []
+    seen = set()
+    for item in menu:
+        if item["id"] not in seen:
+            seen.add(item["id"])
+            entries.append((item["id"], item["name"]))
+    key_entry: List[int] = []
+    key_size: List[int] = []
+    postings: Dict[str, List[int]] = {}
+    for e, texts in enumerate(entries):
+        for text in texts:
+            tris = trigrams(text)
+            if not tris:
+                continue
+            k = len(key_entry)
+            key_entry.append(e)
+            key_size.append(len(tris))
+            for t in tris:
+                postings.setdefault(t, []).append(k)
+    return {
+        "entries": entries,
+        "key_entry": key_entry,
+        "key_size": key_size,
+        "postings": postings,
+    }
+
+
+# ===== Каталог: скомпилированный снимок =====
+# Формат файла: MAGIC | mtime_ns и размер stores.json и menu.json |
+# длина оглавления | оглавление {секция: (смещение, длина)} | секции.
+# Каждая секция (пиццерии, меню, индексы по id, по (item_id, size), по магазину,
+# гео-сетка, триграммы меню) — отдельный marshal-блок. При старте читается
+# только оглавление; секция декодируется из mmap при первом обращении к ней
+# (целиком — это быстрая десериализация, а не работа с данными на месте),
+# поэтому, например, гео-сетка не строится, пока никто не прислал геопозицию.
+SNAPSHOT_MAGIC = b"PFCAT\x07"
+SNAPSHOT_STAMP = struct.Struct("<4q")
+SNAPSHOT_TOC_LEN = struct.Struct("<I")
+SNAPSHOT_HEADER_SIZE = len(SNAPSHOT_MAGIC) + SNAPSHOT_STAMP.size
+
+
+class SnapshotSections:
+    """Секции снимка поверх mmap: каждая декодируется один раз, по требованию."""
+
+    def __init__(self, mm: mmap.mmap, toc: Dict[str, Tuple[int, int]], base: int):
+        self._mm = mm
+        self._toc = toc
+        self._base = base
+        self._cache: Dict[str, Any] = {}
+
+    def __getitem__(self, name: str):
+        if name not in self._cache:
+            offset, size = self._toc[name]
+            start = self._base + offset
+            view = memoryview(self._mm)[start : start + size]
+            try:
+                self._cache[name] = marshal.loads(view)
+            finally:
+                view.release()
+        return self._cache[name]
+
+
+class Catalog:
+    """
+    Пиццерии и меню. Загружается лениво при первом обращении:
+    из снимка через mmap, если он свежий, иначе из JSON с пересборкой снимка.
+    """
+
+    def __init__(self, stores_path: str, menu_path: str, snapshot_path: str):
+        self.stores_path = stores_path
+        self.menu_path = menu_path
+        self.snapshot_path = snapshot_path
+        self._data = None  # SnapshotSections или dict сразу после пересборки
+        self._version = ""
+        # хендлеры TeleBot работают в пуле потоков: снимок читает/собирает один
+        self._load_lock = threading.Lock()
+
+    def _source_stamp(self) -> Optional[Tuple[int, int, int, int]]:
+        try:
+            st_s = os.stat(self.stores_path)
+            st_m = os.stat(self.menu_path)
+        except OSError:
+            # исходников нет — доверяем снимку как есть
+            return None
+        return st_s.st_mtime_ns, st_s.st_size, st_m.st_mtime_ns, st_m.st_size
+
+    def _read_snapshot(self, stamp) -> Optional[SnapshotSections]:
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            if mm[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError("bad magic")
+            saved = SNAPSHOT_STAMP.unpack_from(mm, len(SNAPSHOT_MAGIC))
+            if stamp is not None and saved != stamp:
+                raise ValueError("stale snapshot")
+            (toc_len,) = SNAPSHOT_TOC_LEN.unpack_from(mm, SNAPSHOT_HEADER_SIZE)
+            toc_start = SNAPSHOT_HEADER_SIZE + SNAPSHOT_TOC_LEN.size
+            toc = marshal.loads(mm[toc_start : toc_start + toc_len])
+        except (ValueError, EOFError, TypeError, struct.error):
+            mm.close()
+            return None
+        self._version = self._stamp_version(saved)
+        # mmap остаётся открытым, пока жив каталог: секции читаются из него
+        return SnapshotSections(mm, toc, toc_start + toc_len)
+
+    @staticmethod
+    def _stamp_version(stamp) -> str:
+        return hashlib.blake2s(SNAPSHOT_STAMP.pack(*stamp), digest_size=3).hexdigest()
+
+    @staticmethod
+    def _build(stores: list, menu: list) -> Dict[str, Any]:
+        item_idx: Dict[Tuple[str, str], int] = {}
+        by_store: Dict[str, List[int]] = {}
+        for n, item in enumerate(menu):
+            for size in item["sizes"]:
+                # как и раньше, при дублях выигрывает первая позиция меню
+                item_idx.setdefault((item["id"], size), n)
+            by_store.setdefault(item["store_id"], []).append(n)
+        coords: List[Optional[Tuple[float, float]]] = [
+            None
+            if s.get("lat") is None or s.get("lon") is None
+            else (float(s["lat"]), float(s["lon"]))
+            for s in stores
+        ]
+        by_city: Dict[str, List[int]] = {}
+        for n, s in enumerate(stores):
+            by_city.setdefault(s.get("city"), []).append(n)
+        hours = [parse_hours(s.get("hours")) for s in stores]
+        offsets = [parse_utc_offset(s.get("utc_offset")) for s in stores]
+        cell = grid_cell_size([c for c in coords if c is not None])
+        grid: Dict[Tuple[int, int], List[int]] = {}
+        grid_24h: Dict[Tuple[int, int], List[int]] = {}
+        for n, c in enumerate(coords):
+            if c is not None:
+                xy = grid_cell(c[0], c[1], cell)
+                grid.setdefault(xy, []).append(n)
+                if is_always_open(hours[n]):
+                    grid_24h.setdefault(xy, []).append(n)
+        return {
+            "stores": stores,
+            "menu": menu,
+            "store_idx": {s["id"]: n for n, s in enumerate(stores)},
+            "item_idx": item_idx,
+            "by_store": by_store,
+            "by_city": by_city,
+            "grid": grid,
+            "grid_bbox": grid_bbox(grid),
+            "grid_24h": grid_24h,
+            "grid_24h_bbox": grid_bbox(grid_24h),
+            "grid_cell": cell,
+            "coords": coords,
+            "hours": hours,
+            "offsets": offsets,
+            # различные расписания некруглосуточных пиццерий — их обычно единицы
+            "schedules": list(
+                {(h, o) for h, o in zip(hours, offsets) if not is_always_open(h)}
+            ),
+            "search": _build_search(menu),
+        }
+
+    def compile(self) -> Dict[str, Any]:
+        """Пересобирает снимок из stores.json и menu.json."""
+        stamp = self._source_stamp()
+        data = self._build(load_json(self.stores_path), load_json(self.menu_path))
+        blobs = {name: marshal.dumps(value) for name, value in data.items()}
+        toc, offset = {}, 0
+        for name, blob in blobs.items():
+            toc[name] = (offset, len(blob))
+            offset += len(blob)
+        toc_blob = marshal.dumps(toc)
+        # своё имя у каждого сборщика: при перекрывающемся перезапуске снимок
+        # может собирать и соседний процесс
+        tmp = f"{self.snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(SNAPSHOT_MAGIC)
+                f.write(SNAPSHOT_STAMP.pack(*stamp))
+                f.write(SNAPSHOT_TOC_LEN.pack(len(toc_blob)))
+                f.write(toc_blob)
+                for blob in blobs.values():
+                    f.write(blob)
+            os.replace(tmp, self.snapshot_path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._version = self._stamp_version(stamp)
+        return data
+
+    def _load(self):
+        if self._data is None:
+            with self._load_lock:
+                if self._data is None:
+                    data = self._read_snapshot(self._source_stamp())
+                    self._data = data if data is not None else self.compile()
+        return self._data
+
+    @property
+    def stores(self) -> list:
+        return self._load()["stores"]
+
+    @property
+    def menu(self) -> list:
+        return self._load()["menu"]
+
+    @property
+    def version(self) -> str:
+        """Короткий идентификатор версии каталога (меняется вместе с JSON)."""
+        self._load()
+        return self._version
+
+    def store(self, store_id: str):
+        n = self._load()["store_idx"].get(store_id)
+        return None if n is None else self.stores[n]
+
+    def item(self, item_id: str, size: str):
+        n = self._load()["item_idx"].get((item_id, size))
+        return None if n is None else self.menu[n]
+
+    def items_of(self, store_id: str) -> list:
+        menu = self.menu
+        return [menu[n] for n in self._load()["by_store"].get(store_id, [])]
+
+    def store_number(self, store_id: str) -> Optional[int]:
+        """Номер пиццерии в снимке — короткий ключ для callback_data."""
+        return self._load()["store_idx"].get(store_id)
+
+    def store_numbers_in(self, city: Optional[str]) -> List[int]:
+        """Номера пиццерий города в снимке (пусто, если город неизвестен)."""
+        return self._load()["by_city"].get(city, [])
+
+    def item_numbers_of(self, store_id: str) -> List[int]:
+        return self._load()["by_store"].get(store_id, [])
+
+    def search(self, query: str, limit: int = FIND_LIMIT) -> List[Tuple[float, str, str]]:
+        """Товары, похожие на query: список (сходство, item_id, название), лучшие первыми."""
+        index = self._load()["search"]
+        q = trigrams(query)
+        if not q:
+            return []
+        postings, key_entry, key_size = (
+            index["postings"],
+            index["key_entry"],
+            index["key_size"],
+        )
+        n = len(q)
+        shared: Counter = Counter()
+        for t in q:
+            shared.update(postings.get(t, ()))  # подсчёт идёт в C
+        # Считаем сходство, начиная с ключей с наибольшим числом общих
+        # триграмм. Ключ с c общими набирает не больше 2c / (n + c)
+        # (в нём самом не меньше c триграмм). Как только эта граница
+        # ниже k-го результата, остальные ключи можно не смотреть.
+        # Частые триграммы («пиц», «цца») дают тысячи ключей с c = 1–2.
+        best: Dict[int, float] = {}
+        level = None
+        for k, c in shared.most_common():  # сортировка по c тоже в C
+            if c != level:
+                top = heapq.nlargest(limit, best.values())
+                if len(top) == limit and 2 * c / (n + c) < top[-1]:
+                    break
+                level = c
+            score = 2 * c / (n + key_size[k])
+            e = key_entry[k]
+            if score > best.get(e, 0.0):
+                best[e] = score
+        top = heapq.nlargest(limit, best.items(), key=lambda p: p[1])
+        entries = index["entries"]
+        return [(score, *entries[e]) for e, score in top]
+
+    def nearest_stores(
+        self,
+        lat: float,
+        lon: float,
+        k: int,
+        open_only: bool = True,
+        now=None,
+        max_km: float = NEAREST_STORES_MAX_KM,
+    ) -> List[Tuple[float, Dict[str, Any]]]:
+        """
+        k ближайших (открытых) пиццерий не дальше max_km: список (расстояние_км, пиццерия).
+        Обходим кольца сетки вокруг точки (только в пределах занятых клеток),
+        пока k-й найденный не окажется ближе, чем любая ещё не просмотренная
+        клетка, кольца не выйдут за max_km или не накроют всю сетку.
+        Открыта ли пиццерия, решается по её местному времени (utc_offset).
+        """
+        data = self._load()
+        coords, hours, offsets = data["coords"], data["hours"], data["offsets"]
+        now = time.time() if now is None else now
+        minutes: Dict[Optional[int], int] = {}  # пояс -> текущая минута в нём
+
+        def open_now(h: Optional[Tuple[int, int]], offset: Optional[int]) -> bool:
+            if is_always_open(h):
+                return True
+            if offset not in minutes:
+                minutes[offset] = local_minute(now, offset)
+            return is_open_at(h, minutes[offset])
+
+        grid, bbox = data["grid"], data["grid_bbox"]
+        if open_only and not any(open_now(h, o) for h, o in data["schedules"]):
+            # по расписанию сейчас не работает никто — остаются круглосуточные
+            grid, bbox = data["grid_24h"], data["grid_24h_bbox"]
+        if not grid:
+            return []
+        best: List[Tuple[float, int]] = []  # куча по -расстоянию
+        seen = set()  # у ±180° одну клетку можно пройти из двух сдвигов
+
+        def visit(n: int):
+            if n in seen:
+                return
+            seen.add(n)
+            if open_only and not open_now(hours[n], offsets[n]):
+                return
+            d = haversine_km(lat, lon, *coords[n])
+            if len(best) < k:
+                heapq.heappush(best, (-d, n))
+            elif d < -best[0][0]:
+                heapq.heapreplace(best, (-d, n))
+
+        cell = data["grid_cell"]
+        x0, x1, y0, y1 = bbox
+        # самая высокая широта, где ещё могут быть непросмотренные пиццерии
+        cos_edge = math.cos(math.radians(min(90.0, max(abs(lat), -x0 * cell, (x1 + 1) * cell))))
+        # Кольца считаются в градусах без замыкания по долготе. Пиццерия за ±180°
+        # окажется рядом с точкой, сдвинутой на ∓360°; сдвиг нужен, только если
+        # до сетки в нём меньше 180° по долготе. В «своём» сдвиге граница reach
+        # ниже верна для каждой пиццерии, поэтому обходы можно вести независимо.
+        for shift in (0.0, 360.0, -360.0):
+            qlon = lon + shift
+            if shift and not (y0 * cell - 180.0 <= qlon <= (y1 + 1) * cell + 180.0):
+                continue
+            cx, cy = grid_cell(lat, qlon, cell)
+            # кольца ближе r_first не задевают сетку, после r_last — пустые
+            r_first = max(0, x0 - cx, cx - x1, y0 - cy, cy - y1)
+            r_last = max(cx - x0, x1 - cx, cy - y0, y1 - cy)
+            for r in range(r_first, r_last + 1):
+                for xy in _grid_ring(cx, cy, r, bbox):
+                    for n in grid.get(xy, ()):
+                        visit(n)
+                # всё непросмотренное дальше r клеток хотя бы по одной оси:
+                # по широте это r * cell градусов, по долготе — не меньше дуги ниже
+                dlon = math.radians(min(180.0, r * cell))
+                reach = min(
+                    r * cell * KM_PER_DEG,
+                    2 * EARTH_RADIUS_KM * math.asin(cos_edge * math.sin(dlon / 2)),
+                )
+                if reach >= max_km or (len(best) == k and -best[0][0] <= reach):
+                    break
+
+        stores = self.stores
+        return [(-d, stores[n]) for d, n in sorted(best, reverse=True) if -d <= max_km]
+
+
+# ===== Защита от повторной доставки апдейтов =====
+UPDATES_HWM_PATH = os.path.join(DATA_DIR, "updates.hwm")
+DEDUP_CAPACITY = int(os.getenv("PIZZAFLOW_DEDUP_CAPACITY", "10000"))
+# update_id намного меньше сохранённого — Telegram начал нумерацию заново
+DEDUP_HWM_WINDOW = 1_000_000
+DEDUP_PERSIST_EVERY_S = 1.0
+
+
+class UpdateDeduplicator:
+    """
+    Отсекает повторно доставленные апдейты (переподключение polling,
+    повторы webhook) до того, как они попадут в хендлеры.
+    Ключи — update_id и (chat_id, message_id); последние capacity ключей
+    лежат в OrderedDict, так что проверка стоит O(1). Наибольший update_id
+    раз в DEDUP_PERSIST_EVERY_S сохраняется на диск: после рестарта всё,
+    что не новее него, считается уже обработанным.
+    """
+
+    def __init__(self, hwm_path: str, capacity: int):
+        self.hwm_path = hwm_path
+        self.capacity = capacity
+        self._seen: "OrderedDict[tuple, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._restored_hwm: Optional[int] = None  # читается лениво
+        self._hwm = 0
+        self._saved_hwm = 0
+        self._saved_at = 0.0
+        atexit.register(self.persist)
+
+    def _restore(self):
+        try:
+            with open(self.hwm_path, "r", encoding="utf-8") as f:
+                self._restored_hwm = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            self._restored_hwm = 0
+        self._hwm = self._saved_hwm = self._restored_hwm
+
+    def _remember(self, key: tuple) -> bool:
+        """True, если ключ уже встречался."""
+        if key in self._seen:
+            return True
+        self._seen[key] = None
+        if len(self._seen) > self.capacity:
+            self._seen.popitem(last=False)
+        return False
+
+    def is_duplicate(self, update) -> bool:
+        update_id = update.update_id
+        msg = getattr(update, "message", None)
+        with self._lock:
+            if self._restored_hwm is None:
+                self._restore()
+            if 0 <= self._restored_hwm - update_id < DEDUP_HWM_WINDOW:
+                return True
+            dup = self._remember(("u", update_id))
+            if msg is not None:
+                dup = self._remember(("m", msg.chat.id, msg.message_id)) or dup
+            if dup:
+                return True
+            self._hwm = max(self._hwm, update_id)
+        return False
+
+    def filter(self, updates: list) -> list:
+        fresh = [u for u in updates if not self.is_duplicate(u)]
+        if time.monotonic() - self._saved_at >= DEDUP_PERSIST_EVERY_S:
+            self.persist()
+        return fresh
+
+    def persist(self):
+        with self._lock:
+            hwm = self._hwm
+            if hwm == self._saved_hwm:
+                return
+            tmp = self.hwm_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(str(hwm))
+            os.replace(tmp, self.hwm_path)
+            self._saved_hwm = hwm
+            self._saved_at = time.monotonic()
+
+
+# ===== Ленивый бот =====
+class LatencyRecorder:
+    """Кольцевой буфер последних замеров хендлеров: (время начала, длительность)."""
+
+    def __init__(self, size: int = 10000):
+        self._samples: deque = deque(maxlen=size)
+
+    def record(self, started: float, duration: float):
+        self._samples.append((started, duration))
+
+    def between(self, start: float, end: float) -> List[float]:
+        return [d for t, d in list(self._samples) if start <= t < end]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, Any]:
+    """n, p50, p95 и max в миллисекундах."""
+    if not samples:
+        return {"n": 0, "p50": None, "p95": None, "max": None}
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+    return {"n": len(ordered), "p50": pick(0.5), "p95": pick(0.95), "max": pick(1.0)}
+
+
+class LazyBot:
+    """
+    Обёртка над TeleBot: telebot импортируется и бот создаётся только при
+    первом обращении к API. Хендлеры, объявленные декораторами, запоминаются
+    и регистрируются на настоящем боте в момент его создания.
+    update_filter (если задан) пропускает через себя каждую пачку апдейтов
+    перед process_new_updates — и для polling, и для webhook.
+    latency (если задан) получает длительность каждого вызова хендлера.
+    """
+
+    def __init__(self, token: str, update_filter=None, latency: Optional[LatencyRecorder] = None):
+        self._token = token
+        self._bot = None
+        self._handlers: List[Tuple[str, Dict[str, Any], Any]] = []
+        self._update_filter = update_filter
+        self._latency = latency
+
+    def _timed(self, fn):
+        latency = self._latency
+        if latency is None:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                latency.record(started, time.monotonic() - started)
+
+        return wrapper
+
+    def _register(self, kind: str, kwargs: Dict[str, Any]):
+        def decorator(fn):
+            timed = self._timed(fn)
+            self._handlers.append((kind, kwargs, timed))
+            if self._bot is not None:
+                getattr(self._bot, kind)(**kwargs)(timed)
+            return fn
+
+        return decorator
+
+    def message_handler(self, **kwargs):
+        return self._register("message_handler", kwargs)
+
+    def callback_query_handler(self, **kwargs):
+        return self._register("callback_query_handler", kwargs)
+
+    def _get(self):
+        if self._bot is None:
+            from telebot import TeleBot
+
+            real = TeleBot(self._token)
+            for kind, kwargs, fn in self._handlers:
+                getattr(real, kind)(**kwargs)(fn)
+            if self._update_filter is not None:
+                self._wrap_updates(real)
+            self._bot = real
+        return self._bot
+
+    def _wrap_updates(self, real):
+        process = real.process_new_updates
+
+        def process_new_updates(updates):
+            # offset для getUpdates сдвигаем и за отброшенные апдейты,
+            # иначе Telegram будет присылать их снова
+            if updates:
+                last = max(u.update_id for u in updates)
+                real.last_update_id = max(real.last_update_id, last)
+            fresh = self._update_filter(updates)
+            if fresh:
+                process(fresh)
+
+        real.process_new_updates = process_new_updates
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+
+# ===== История и выгрузка заказов =====
+HISTORY_PAGE_SIZE = 5
+EXPORT_DIR = os.path.join(DATA_DIR, "exports")
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_KEEP = int(os.getenv("PIZZAFLOW_EXPORT_KEEP", "3"))  # столько последних выгрузок храним
+# больше Bot API не примет: такую выгрузку забирают с сервера по пути из ответа
+TELEGRAM_UPLOAD_LIMIT = 50 * 2**20
+EXPORT_CSV_HEADER = [
+    "order_id", "user_id", "store_id", "total", "status", "created_at",
+    "item_id", "item_name", "size", "qty", "price",
+]
+# id администраторов через запятую: /export доступен только им
+ADMIN_IDS = {x.strip() for x in os.getenv("PIZZAFLOW_ADMIN_IDS", "").split(",") if x.strip()}
+
+
+def encode_history_cursor(order: Dict[str, Any]) -> str:
+    return f"{order['created_at']}:{order['id']}"
+
+
+def decode_history_cursor(cursor: str) -> Optional[Tuple[int, str]]:
+    created_at, sep, order_id = cursor.partition(":")
+    if not sep or not created_at.isdigit():
+        return None
+    return int(created_at), order_id
+
+
+def export_orders(path: str, fmt: str) -> int:
+    """
+    Потоково выгружает все заказы с позициями в CSV (строка на позицию)
+    или JSONL (строка на заказ); путь на .gz — сразу в gzip.
+    Возвращает число заказов.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    count = 0
+    with opener(path, "wt", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer:
+            writer.writerow(EXPORT_CSV_HEADER)
+        for order in db.iter_orders_with_items():
+            count += 1
+            if writer is None:
+                f.write(json.dumps(order, ensure_ascii=False) + "\n")
+                continue
+            head = [
+                order["id"], order["user_id"], order["store_id"],
+                order["total"], order["status"], order["created_at"],
+            ]
+            for it in order["items"] or [{}]:
+                writer.writerow(
+                    head
+                    + [
+                        it.get("item_id"), it.get("item_name"), it.get("size"),
+                        it.get("qty"), it.get("price"),
+                    ]
+                )
+    return count
+
+
+_export_lock = threading.Lock()
+
+
+def prune_exports(keep: int):
+    # имена orders-ГГГГММДД-ЧЧММСС.* сортируются по времени
+    names = sorted(n for n in os.listdir(EXPORT_DIR) if n.startswith("orders-"))
+    for name in names[: max(0, len(names) - keep)]:
+        os.remove(os.path.join(EXPORT_DIR, name))
+
+
+def run_export(chat_id: int, fmt: str):
+    """Фоновая выгрузка для /export: gzip-файл в EXPORT_DIR, ответ — в чат."""
+    try:
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(EXPORT_DIR, f"orders-{stamp}.{fmt}.gz")
+        count = export_orders(path, fmt)
+        prune_exports(EXPORT_KEEP)
+        size = os.path.getsize(path)
+        if size > TELEGRAM_UPLOAD_LIMIT:
+            bot.send_message(
+                chat_id,
+                f"Заказов: {count}. Файл {size / 2**20:.0f} МБ больше лимита Telegram, "
+                f"он лежит на сервере: {path}",
+            )
+            return
+        with open(path, "rb") as f:
+            bot.send_document(chat_id, f, caption=f"Заказов: {count}")
+    except Exception as e:
+        print(f"export failed: {e}")
+        bot.send_message(chat_id, f"Выгрузка не удалась: {e}")
+    finally:
+        _export_lock.release()
+
+
+# ===== Онлайн-бэкапы app.db =====
+BACKUP_DIR = os.path.join(DATA_DIR, "backups")
+# 0 — планировщик выключен (бэкап всё равно можно снять командой /backup)
+BACKUP_INTERVAL_S = int(os.getenv("PIZZAFLOW_BACKUP_INTERVAL", "0"))
+BACKUP_KEEP = int(os.getenv("PIZZAFLOW_BACKUP_KEEP", "7"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("PIZZAFLOW_BACKUP_PAGES", "64"))
+BACKUP_STEP_SLEEP_S = float(os.getenv("PIZZAFLOW_BACKUP_SLEEP", "0.005"))
+BACKUP_TABLES = ("users", "cart_items", "orders", "order_items")
+
+
+def verify_backup(path: str) -> Dict[str, int]:
+    """
+    Проверка восстановимости: открываем файл бэкапа только на чтение
+    и проверяем целостность всех страниц, версию схемы и таблицы.
+    Возвращает число строк по таблицам; при проблеме — sqlite3.DatabaseError.
+    """
+    src = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        cur = src.cursor()
+        cur.execute("PRAGMA integrity_check")
+        result = cur.fetchone()[0]
+        if result != "ok":
+            raise sqlite3.DatabaseError(f"integrity_check: {result}")
+        cur.execute("PRAGMA user_version")
+        version = cur.fetchone()[0]
+        if version != SCHEMA_VERSION:
+            raise sqlite3.DatabaseError(f"schema version {version}, expected {SCHEMA_VERSION}")
+        counts = {}
+        for table in BACKUP_TABLES:
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            counts[table] = cur.fetchone()[0]
+        return counts
+    finally:
+        src.close()
+
+
+def restore_backup(path: str, db_path: str):
+    """Восстанавливает db_path из бэкапа (бот при этом должен быть остановлен)."""
+    verify_backup(path)
+    src = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    dst = sqlite3.connect(db_path)
+    try:
+        src.backup(dst)
+        # бэкап хранится в режиме DELETE, рабочей БД нужен WAL (см. BackupManager)
+        dst.execute("PRAGMA journal_mode = WAL")
+    finally:
+        src.close()
+        dst.close()
+
+
+class BackupManager:
+    """
+    Бэкапы живой БД через онлайн backup API SQLite.
+    Копирование идёт шагами по pages страниц с паузой между шагами. В режиме
+    WAL источник держит одну читающую транзакцию на весь бэкап: это снимок
+    на момент начала, писатели при этом не ждут, а бэкап не перезапускается
+    от их коммитов. Если с прошлого бэкапа БД не менялась (PRAGMA
+    data_version), новый файл не создаётся. Хранятся последние keep файлов,
+    каждый проверяется verify_backup до того, как попасть в каталог.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        backup_dir: str,
+        keep: int,
+        pages: int,
+        step_sleep: float,
+        latency: Optional[LatencyRecorder] = None,
+    ):
+        self.db_path = db_path
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self.pages = pages
+        self.step_sleep = step_sleep
+        self.latency = latency
+        self._src: Optional[sqlite3.Connection] = None
+        self._last_version: Optional[int] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        # внеочередные бэкапы (/backup): колбэки done(report, error)
+        self._requests: List[Any] = []
+        self._requests_lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def _source(self) -> sqlite3.Connection:
+        if self._src is None:
+            DB(self.db_path)._connect().close()  # схема и WAL, если файла ещё нет
+            self._src = sqlite3.connect(
+                self.db_path, isolation_level=None, check_same_thread=False
+            )
+        return self._src
+
+    def _prune(self):
+        names = os.listdir(self.backup_dir)
+        files = sorted(f for f in names if f.startswith("app-") and f.endswith(".db"))
+        # .part остаются от копий, прерванных падением или kill; текущая уже переименована
+        stale = [f for f in names if f.startswith("app-") and f.endswith(".db.part")]
+        for name in files[: max(0, len(files) - self.keep)] + stale:
+            os.remove(os.path.join(self.backup_dir, name))
+
+    def backup(self, force: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Снимает бэкап и возвращает отчёт (файл, время, шаги, строки по таблицам,
+        задержки хендлеров до и во время бэкапа); None — если БД не менялась.
+        """
+        with self._lock:
+            src = self._source()
+            cur = src.cursor()
+            cur.execute("PRAGMA data_version")
+            version = cur.fetchone()[0]
+            if not force and version == self._last_version:
+                return None
+            cur.execute("PRAGMA journal_mode")
+            wal = cur.fetchone()[0] == "wal"
+
+            os.makedirs(self.backup_dir, exist_ok=True)
+            now = time.time()
+            name = time.strftime("app-%Y%m%d-%H%M%S", time.localtime(now))
+            path = os.path.join(self.backup_dir, f"{name}-{int(now * 1000) % 1000:03d}.db")
+            tmp = path + ".part"
+            steps = 0
+
+            def progress(status, remaining, total):
+                nonlocal steps
+                steps += 1
+                time.sleep(self.step_sleep)  # окно для писателей между шагами
+
+            started = time.monotonic()
+            dst = sqlite3.connect(tmp)
+            try:
+                if wal:
+                    cur.execute("BEGIN")
+                    cur.execute("SELECT COUNT(*) FROM sqlite_master")
+                    cur.fetchone()
+                try:
+                    src.backup(dst, pages=self.pages, progress=progress)
+                finally:
+                    if wal:
+                        cur.execute("COMMIT")
+                # бэкап — один самодостаточный файл, без -wal/-shm рядом
+                dst.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                dst.close()
+            finished = time.monotonic()
+            try:
+                counts = verify_backup(tmp)
+                os.replace(tmp, path)
+            except Exception:
+                os.remove(tmp)  # непроверенный файл в каталоге бэкапов не оставляем
+                raise
+            self._last_version = version
+            self._prune()
+
+        report: Dict[str, Any] = {
+            "path": path,
+            "seconds": round(finished - started, 3),
+            "steps": steps,
+            "wal_snapshot": wal,
+            "rows": counts,
+        }
+        if self.latency is not None:
+            window = finished - started
+            report["latency_before"] = latency_summary(
+                self.latency.between(started - max(window, 60.0), started)
+            )
+            report["latency_during"] = latency_summary(
+                self.latency.between(started, finished)
+            )
+        print(f"backup: {report}")
+        return report
+
+    def _run(self, interval: Optional[float]):
+        # interval None — только внеочередные бэкапы по request()
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            with self._requests_lock:
+                waiting, self._requests = self._requests, []
+            report, error = None, None
+            try:
+                report = self.backup(force=bool(waiting))
+            except (sqlite3.Error, OSError) as e:
+                error = e
+                print(f"backup failed: {e}")
+            for done in waiting:
+                try:
+                    done(report, error)
+                except Exception as e:
+                    print(f"backup: callback failed: {e}")
+
+    def start(self, interval: Optional[float]):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, args=(interval,), name="backup", daemon=True
+            )
+            self._thread.start()
+
+    def request(self, done):
+        """
+        Просит поток бэкапов снять бэкап вне расписания. done(report, error)
+        вызывается из этого потока, когда бэкап готов или не удался.
+        """
+        with self._requests_lock:
+            self._requests.append(done)
+        self.start(None)  # без планировщика поток поднимется только ради запросов
+        self._wake.set()
+
+
+# ===== Заказ через inline-клавиатуры =====
+# callback_data: "<op>|<версия каталога>|<аргументы>" (лимит Telegram — 64 байта)
+#   s|v|<№ пиццерии>          — открыть меню
+#   a|v|<№ позиции>|<размер>  — добавить в корзину 1 шт.
+#   c|v|<№ пиццерии>          — оформить и оплатить
+#   x|v|<№ пиццерии>          — очистить корзину
+#   b|v                       — назад к пиццериям
+# Номера — позиции в снимке каталога, поэтому кнопки от старой версии
+# каталога отклоняются.
+CB_SEP = "|"
+# Telegram принимает до 100 кнопок, но длинный список всё равно никто не листает
+STORES_KEYBOARD_LIMIT = 20
+
+
+def callback_data(op: str, version: str, *args) -> str:
+    return CB_SEP.join((op, version) + tuple(str(a) for a in args))
+
+
+def resolve_city(city: Optional[str]) -> Optional[str]:
+    """Город пользователя, если в нём есть пиццерии; иначе None."""
+    return city if city and CATALOG.store_numbers_in(city) else None
+
+
+def stores_prompt(city: Optional[str]) -> str:
+    if resolve_city(city) is None and len(CATALOG.stores) > STORES_KEYBOARD_LIMIT:
+        return (
+            f"Выберите пиццерию (показаны первые {STORES_KEYBOARD_LIMIT}).\n"
+            "Укажите адрес через /address или отправьте геопозицию — покажу ближайшие."
+        )
+    return "Выберите пиццерию:"
+
+
+def build_stores_keyboard(version: str, city: Optional[str]):
+    """city — уже проверенный resolve_city; None — все пиццерии, первые STORES_KEYBOARD_LIMIT."""
+    from telebot import types
+
+    numbers = CATALOG.store_numbers_in(city) if city else range(len(CATALOG.stores))
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    for n in list(numbers)[:STORES_KEYBOARD_LIMIT]:
+        store = CATALOG.stores[n]
+        kb.add(
+            types.InlineKeyboardButton(
+                f"{store['name']} — {store['address']}",
+                callback_data=callback_data("s", version, n),
+            )
+        )
+    return kb
+
+
+def build_nearest_keyboard(version: str, found: List[Tuple[float, Dict[str, Any]]]):
+    """Кнопки ближайших пиццерий для cmd_location; не кэшируется — зависит от точки."""
+    from telebot import types
+
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    for d, store in found:
+        kb.add(
+            types.InlineKeyboardButton(
+                f"{store['name']} — {store['address']} ({d:.1f} км)",
+                callback_data=callback_data("s", version, CATALOG.store_number(store["id"])),
+            )
+        )
+    return kb
+
+
+def build_menu_keyboard(version: str, store_id: str):
+    from telebot import types
+
+    n_store = CATALOG.store_number(store_id)
+    kb = types.InlineKeyboardMarkup()
+    for n in CATALOG.item_numbers_of(store_id):
+        item = CATALOG.menu[n]
+        buttons = [
+            types.InlineKeyboardButton(
+                f"{item['name']} {size} · {price}₽" if i == 0 else f"{size} · {price}₽",
+                callback_data=callback_data("a", version, n, size),
+            )
+            for i, (size, price) in enumerate(item["sizes"].items())
+        ]
+        kb.row(*buttons)
+    kb.row(
+        types.InlineKeyboardButton(
+            "✅ Оформить и оплатить", callback_data=callback_data("c", version, n_store)
+        )
+    )
+    kb.row(
+        types.InlineKeyboardButton("🗑 Очистить", callback_data=callback_data("x", version, n_store)),
+        types.InlineKeyboardButton("⬅ Пиццерии", callback_data=callback_data("b", version)),
+    )
+    return kb
+
+
+class KeyboardCache:
+    """
+    Готовые InlineKeyboardMarkup: строятся один раз на город / пиццерию
+    и живут, пока не сменится версия каталога. Ключ списка пиццерий — город
+    из каталога или None, поэтому произвольные адреса кэш не раздувают.
+    """
+
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        self._version: Optional[str] = None
+        self._cache: Dict[Tuple[str, Any], Any] = {}
+
+    def _get(self, key: Tuple[str, Any], build):
+        version = self.catalog.version
+        if version != self._version:
+            self._cache = {}
+            self._version = version
+        markup = self._cache.get(key)
+        if markup is None:
+            markup = self._cache[key] = build(version)
+        return markup
+
+    def stores(self, city: Optional[str]):
+        city = resolve_city(city)
+        return self._get(("stores", city), lambda v: build_stores_keyboard(v, city))
+
+    def menu(self, store_id: str):
+        return self._get(("menu", store_id), lambda v: build_menu_keyboard(v, store_id))
+
+
+def inline_menu_text(store: Dict[str, Any], uid: str) -> str:
+    total = carts.cart_total(uid)
+    cart_line = f"🧺 В корзине: {format_rub(total)}" if total else "🧺 Корзина пуста"
+    return (
+        f"Меню {store['name']}:\n"
+        "Нажмите на размер — добавится 1 шт.\n\n" + cart_line
+    )
+
+
 # ===== Логика из заданий 2 и 3 (условия + функции) =====
 def validate_name(name: str) -> str:
     """
@@ -382,13 +2064,78 @@ def check_age(age: int) -> str:
         return "Возраст подходит, можно продолжать регистрацию и пользоваться приложением."
 
 
+def user_city(uid: str) -> Optional[str]:
+    """Город — первая часть адреса до запятой."""
+    user = db.get_user(uid)
+    return (
+        user.get("address", "").split(",")[0].strip()
+        if user.get("address")
+        else None
+    )
+
+
+def place_order(uid: str, store_id: str) -> Tuple[Optional[str], int, str]:
+    """
+    Оформляет корзину пользователя в заказ пиццерии store_id.
+    Возвращает (order_id, сумма, "") или (None, 0, текст ошибки).
+    """
+    cart = carts.get_cart(uid)
+    if not cart:
+        return None, 0, "Корзина пуста."
+    if any(p["store_id"] != store_id for p in cart):
+        return (
+            None,
+            0,
+            "Все позиции в заказе должны быть из одной пиццерии. "
+            "Очистите корзину или добавьте позиции из одного магазина.",
+        )
+    total = carts.cart_total(uid)
+    order_id = db.create_order(uid, store_id, cart, total)
+    carts.clear_cart(uid)
+    return order_id, total, ""
+
+
+def charge_order(order: Dict[str, Any], outcome: str = "ok") -> Dict[str, Any]:
+    """Эмуляция оплаты заказа; статус заказа обновляется по результату."""
+    result = MockPaymentProvider.charge(order["id"], order["total"], outcome=outcome)
+    status = "Confirmed" if result["status"] == "Succeeded" else "Pending"
+    db.set_order_status(order["id"], status)
+    return result
+
+
+def find_menu_item(item_id: str, size: str):
+    """
+    Ищет позицию меню по item_id и размеру. Если точного совпадения нет,
+    берёт самый похожий товар (см. Catalog.search) — только если он один
+    или обходит второй хотя бы на FUZZY_MIN_MARGIN и у него есть такой размер.
+    Возвращает (позиция или None, item_id похожих товаров для подсказки).
+    """
+    candidate = CATALOG.item(item_id, size)
+    if candidate:
+        return candidate, []
+    matches = CATALOG.search(item_id, limit=3)
+    if matches and matches[0][0] >= FUZZY_MIN_SCORE:
+        clear = len(matches) == 1 or matches[0][0] - matches[1][0] >= FUZZY_MIN_MARGIN
+        if clear:
+            candidate = CATALOG.item(matches[0][1], size)
+            if candidate:
+                return candidate, []
+    return None, [found_id for _, found_id, _ in matches]
+
+
+def suggestion_hint(suggestions: List[str]) -> str:
+    if not suggestions:
+        return ""
+    return " Может быть: " + ", ".join(suggestions) + "?"
+
+
 def process_batch_items(uid: str, *raw_items: str):
     """
     Обрабатывает несколько позиций заказа сразу.
     raw_items — строки вида 'pepperoni M 2', 'cheese L 1' и т.п.
     Возвращает (added_lines, error_lines, updated_cart).
     """
-    cart = db.get_cart(uid)
+    cart = carts.get_cart(uid)
     added_lines: List[str] = []
     error_lines: List[str] = []
 
@@ -415,21 +2162,19 @@ def process_batch_items(uid: str, *raw_items: str):
             )
             continue
 
-        # поиск товара в меню
-        candidate = next(
-            (i for i in MENU if i["id"] == item_id and size in i["sizes"]),
-            None,
-        )
+        # поиск товара в меню (с поправкой на опечатки)
+        candidate, suggestions = find_menu_item(item_id, size)
         if not candidate:
             error_lines.append(
                 f"«{chunk}» — такого товара/размера нет в меню."
+                + suggestion_hint(suggestions)
             )
             continue
 
         price = int(candidate["sizes"][size])
         cart.append(
             {
-                "item_id": item_id,
+                "item_id": candidate["id"],
                 "item_name": candidate["name"],
                 "store_id": candidate["store_id"],
                 "size": size,
@@ -442,7 +2187,7 @@ def process_batch_items(uid: str, *raw_items: str):
         )
 
     if added_lines:
-        db.set_cart(uid, cart)
+        carts.set_cart(uid, cart)
 
     return added_lines, error_lines, cart
 
@@ -478,28 +2223,25 @@ def process_batch_items_recursive(
                 qty = int(qty_s)
                 if qty <= 0:
                     raise ValueError
-                candidate = next(
-                    (i for i in MENU if i["id"] == item_id and size in i["sizes"]),
-                    None,
-                )
+                candidate, suggestions = find_menu_item(item_id, size)
                 if not candidate:
                     errors.append(
                         f"«{chunk}» — такого товара/размера нет в меню."
+                        + suggestion_hint(suggestions)
                     )
                 else:
                     price = int(candidate["sizes"][size])
-                    cart = db.get_cart(uid)
-                    cart.append(
+                    carts.add_item(
+                        uid,
                         {
-                            "item_id": item_id,
+                            "item_id": candidate["id"],
                             "item_name": candidate["name"],
                             "store_id": candidate["store_id"],
                             "size": size,
                             "qty": qty,
                             "price": price,
-                        }
+                        },
                     )
-                    db.set_cart(uid, cart)
                     added.append(
                         f"{candidate['name']} {size} x{qty} — {price * qty} ₽"
                     )
@@ -513,10 +2255,34 @@ def process_batch_items_recursive(
 
 
 # ===== Инициализация =====
+# всё лениво: схема БД, каталог и TeleBot поднимаются при первом обращении
 db = DB(DB_PATH)
-STORES = load_json(STORES_PATH)
-MENU = load_json(MENU_PATH)
-bot = TeleBot(TOKEN)
+if CART_BACKEND == "memory":
+    carts = CartStore(CART_JOURNAL_PATH, CART_TTL, CART_COMPACT_AFTER, legacy=db)
+    if CART_WRITE_BEHIND:
+        print("PIZZAFLOW_CART_WRITE_BEHIND is ignored with the memory cart backend")
+else:
+    if CART_WRITE_BEHIND:
+        db = WriteBehindDB(db, CART_FLUSH_INTERVAL_MS, CART_FLUSH_MAX_OPS)
+    carts = db
+CATALOG = Catalog(STORES_PATH, MENU_PATH, CATALOG_SNAPSHOT_PATH)
+dedup = UpdateDeduplicator(UPDATES_HWM_PATH, DEDUP_CAPACITY)
+handler_latency = LatencyRecorder()
+bot = LazyBot(TOKEN, update_filter=dedup.filter, latency=handler_latency)
+keyboards = KeyboardCache(CATALOG)
+backups = BackupManager(
+    DB_PATH, BACKUP_DIR, BACKUP_KEEP, BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP_S,
+    handler_latency,
+)
+
+
+def __getattr__(name):
+    # совместимость: STORES / MENU как атрибуты модуля
+    if name == "STORES":
+        return CATALOG.stores
+    if name == "MENU":
+        return CATALOG.menu
+    raise AttributeError(name)
 
 
 # ===== Команды =====
@@ -529,14 +2295,18 @@ def cmd_start(m):
         "/name <имя> — проверить и сохранить имя\n"
         "/age <число> — проверить возраст\n"
         "/address — задать адрес (строкой)\n"
+        "/order — заказ кнопками (пиццерия → меню → оплата)\n"
         "/stores — список пиццерий\n"
+        "📍 геопозиция — ближайшие открытые пиццерии\n"
         "/menu <store_id> — меню пиццерии\n"
+        "/find <текст> — найти товар в меню\n"
         "/add <item_id> <size> <qty> — добавить одну позицию в корзину\n"
         "/add_batch <список> — добавить сразу несколько позиций\n"
         "/cart — показать корзину\n"
         "/confirm <store_id> — оформить заказ\n"
         "/pay — оплата (эмуляция) | /pay fail — отказ\n"
         "/status — статус последнего заказа\n"
+        "/history — история заказов\n"
         "/cancel — очистить корзину"
     )
     bot.reply_to(m, text)
@@ -616,27 +2386,45 @@ def cmd_address(m):
 @bot.message_handler(commands=["stores"])
 def cmd_stores(m):
     uid = str(m.from_user.id)
-    user = db.get_user(uid)
-    city = (
-        user.get("address", "").split(",")[0].strip()
-        if user.get("address")
-        else None
-    )
+    city = user_city(uid)
     lines = []
-    for s in STORES:
+    for s in CATALOG.stores:
         if city and s["city"] != city:
             continue
         lines.append(f"- {s['name']} [{s['id']}] — {s['city']}, {s['address']}")
     if not lines:
         lines = [
             f"- {s['name']} [{s['id']}] — {s['city']}, {s['address']}"
-            for s in STORES
+            for s in CATALOG.stores
         ]
-        bot.reply_to(m, "По адресу город не распознан, покажу все пиццерии:\n" + "\n".join(lines))
+        bot.reply_to(
+            m,
+            "По адресу город не распознан, покажу все пиццерии:\n"
+            + "\n".join(lines)
+            + "\n\nОтправьте геопозицию — покажу ближайшие открытые.",
+        )
     else:
         bot.reply_to(m, "Доступные пиццерии:\n" + "\n".join(lines))
 
 
+@bot.message_handler(content_types=["location"])
+def cmd_location(m):
+    """Пользователь поделился геопозицией — покажем ближайшие открытые пиццерии."""
+    loc = m.location
+    found = CATALOG.nearest_stores(loc.latitude, loc.longitude, NEAREST_STORES_K)
+    if not found:
+        bot.reply_to(
+            m, f"В радиусе {NEAREST_STORES_MAX_KM:.0f} км нет открытых пиццерий."
+        )
+        return
+    # кнопки ведут в тот же inline-заказ, что и /order
+    bot.reply_to(
+        m,
+        "Ближайшие открытые пиццерии — нажмите, чтобы открыть меню:",
+        reply_markup=build_nearest_keyboard(CATALOG.version, found),
+    )
+
+
 @bot.message_handler(commands=["menu"])
 def cmd_menu(m):
     parts = m.text.split()
@@ -647,11 +2435,11 @@ def cmd_menu(m):
         )
         return
     store_id = parts[1]
-    store = find_store(store_id, STORES)
+    store = CATALOG.store(store_id)
     if not store:
         bot.reply_to(m, "Пиццерия не найдена.")
         return
-    items = [x for x in MENU if x["store_id"] == store_id]
+    items = CATALOG.items_of(store_id)
     if not items:
         bot.reply_to(m, "Меню пусто.")
         return
@@ -668,6 +2456,29 @@ def cmd_menu(m):
     )
 
 
+@bot.message_handler(commands=["find"])
+def cmd_find(m):
+    """
+    /find пеперони
+    Нечёткий поиск по меню: опечатки, кириллица и латиница.
+    """
+    parts = m.text.split(" ", 1)
+    if len(parts) < 2 or not parts[1].strip():
+        bot.reply_to(m, "Использование: /find <текст>\nНапример: /find пепперони")
+        return
+    matches = CATALOG.search(parts[1])
+    if not matches:
+        bot.reply_to(m, "Ничего похожего в меню нет.")
+        return
+    lines = [f"- {name} — {item_id}" for _, item_id, name in matches]
+    bot.reply_to(
+        m,
+        "Нашлось в меню:\n"
+        + "\n".join(lines)
+        + "\n\nДобавьте позицию: /add <item_id> <size> <qty>",
+    )
+
+
 @bot.message_handler(commands=["add"])
 def cmd_add(m):
     parts = m.text.split()
@@ -686,27 +2497,24 @@ def cmd_add(m):
         bot.reply_to(m, "Количество должно быть положительным числом.")
         return
 
-    candidate = next(
-        (i for i in MENU if i["id"] == item_id and size in i["sizes"]), None
-    )
+    candidate, suggestions = find_menu_item(item_id, size)
     if not candidate:
-        bot.reply_to(m, "Такого товара/размера нет в меню.")
+        bot.reply_to(m, "Такого товара/размера нет в меню." + suggestion_hint(suggestions))
         return
 
     uid = str(m.from_user.id)
-    cart = db.get_cart(uid)
     price = int(candidate["sizes"][size])
-    cart.append(
+    carts.add_item(
+        uid,
         {
-            "item_id": item_id,
+            "item_id": candidate["id"],
             "item_name": candidate["name"],
             "store_id": candidate["store_id"],
             "size": size,
             "qty": qty,
             "price": price,
-        }
+        },
     )
-    db.set_cart(uid, cart)
     bot.reply_to(
         m,
         f"✅ Добавлено: {candidate['name']} {size} x{qty} — {price * qty} ₽",
@@ -757,14 +2565,14 @@ def cmd_add_batch(m):
 @bot.message_handler(commands=["cart"])
 def cmd_cart(m):
     uid = str(m.from_user.id)
-    cart = db.get_cart(uid)
+    cart = carts.get_cart(uid)
     if not cart:
         bot.reply_to(
             m,
             "Корзина пуста. Добавьте позиции командой /add или /add_batch",
         )
         return
-    total = sum(p["price"] * p["qty"] for p in cart)
+    total = carts.cart_total(uid)
     lines = [
         f"- {p['item_name']} {p['size']} x{p['qty']} — {p['price'] * p['qty']} ₽ (store:{p['store_id']})"
         for p in cart
@@ -786,20 +2594,10 @@ def cmd_confirm(m):
         return
     store_id = parts[1]
     uid = str(m.from_user.id)
-    cart = db.get_cart(uid)
-    if not cart:
-        bot.reply_to(m, "Корзина пуста.")
+    order_id, total, error = place_order(uid, store_id)
+    if not order_id:
+        bot.reply_to(m, error)
         return
-    if any(p["store_id"] != store_id for p in cart):
-        bot.reply_to(
-            m,
-            "Все позиции в заказе должны быть из одной пиццерии. "
-            "Очистите корзину или добавьте позиции из одного магазина.",
-        )
-        return
-    total = sum(p["price"] * p["qty"] for p in cart)
-    order_id = db.create_order(uid, store_id, cart, total)
-    db.clear_cart(uid)
     bot.reply_to(
         m,
         f"🧾 Заказ создан #{order_id}. Сумма: {total} ₽\n"
@@ -823,18 +2621,14 @@ def cmd_pay(m):
         bot.reply_to(m, "Этот заказ уже завершён.")
         return
 
-    result = MockPaymentProvider.charge(
-        order["id"], order["total"], outcome=outcome
-    )
+    result = charge_order(order, outcome)
     if result["status"] == "Succeeded":
-        db.set_order_status(order["id"], "Confirmed")
         bot.reply_to(
             m,
             f"✅ Оплата (эмуляция) прошла: {result['amount']} ₽. "
             f"Статус заказа #{order['id']}: Confirmed\nПроверьте статус: /status",
         )
     else:
-        db.set_order_status(order["id"], "Pending")
         bot.reply_to(
             m,
             f"❌ Оплата (эмуляция) отклонена. "
@@ -852,14 +2646,198 @@ def cmd_status(m):
     bot.reply_to(m, f"Статус заказа #{order['id']}: {order['status']}")
 
 
+@bot.message_handler(commands=["order"])
+def cmd_order(m):
+    """
+    /order — заказ кнопками: пиццерия → позиции → оформить и оплатить.
+    """
+    uid = str(m.from_user.id)
+    city = user_city(uid)
+    bot.reply_to(m, stores_prompt(city), reply_markup=keyboards.stores(city))
+
+
+@bot.callback_query_handler(func=lambda c: True)
+def cb_order(c):
+    op, _, rest = c.data.partition(CB_SEP)
+    version, _, args = rest.partition(CB_SEP)
+    if op not in ("s", "a", "c", "x", "b"):
+        bot.answer_callback_query(c.id)
+        return
+    if version != CATALOG.version:
+        bot.answer_callback_query(c.id, "Меню обновилось, откройте заново: /order")
+        return
+    uid = str(c.from_user.id)
+    chat_id, message_id = c.message.chat.id, c.message.message_id
+
+    if op == "b":
+        city = user_city(uid)
+        bot.edit_message_text(
+            stores_prompt(city), chat_id, message_id,
+            reply_markup=keyboards.stores(city),
+        )
+        bot.answer_callback_query(c.id)
+        return
+
+    if op == "a":
+        n, _, size = args.partition(CB_SEP)
+        item = CATALOG.menu[int(n)]
+        price = int(item["sizes"][size])
+        carts.add_item(
+            uid,
+            {
+                "item_id": item["id"],
+                "item_name": item["name"],
+                "store_id": item["store_id"],
+                "size": size,
+                "qty": 1,
+                "price": price,
+            },
+        )
+        store = CATALOG.store(item["store_id"])
+        bot.edit_message_text(
+            inline_menu_text(store, uid), chat_id, message_id,
+            reply_markup=keyboards.menu(store["id"]),
+        )
+        bot.answer_callback_query(c.id, f"✅ {item['name']} {size} — {price} ₽")
+        return
+
+    store = CATALOG.stores[int(args)]
+    if op == "s":
+        bot.edit_message_text(
+            inline_menu_text(store, uid), chat_id, message_id,
+            reply_markup=keyboards.menu(store["id"]),
+        )
+        bot.answer_callback_query(c.id)
+    elif op == "x":
+        if carts.cart_total(uid):
+            carts.clear_cart(uid)
+            # без изменений текста Telegram отвечает ошибкой, поэтому правим только тут
+            bot.edit_message_text(
+                inline_menu_text(store, uid), chat_id, message_id,
+                reply_markup=keyboards.menu(store["id"]),
+            )
+        bot.answer_callback_query(c.id, "🗑 Корзина очищена.")
+    elif op == "c":
+        order_id, total, error = place_order(uid, store["id"])
+        if not order_id:
+            bot.answer_callback_query(c.id, error, show_alert=True)
+            return
+        result = charge_order({"id": order_id, "total": total})
+        if result["status"] == "Succeeded":
+            text = (
+                f"🧾 Заказ #{order_id} на {format_rub(total)} оплачен (эмуляция).\n"
+                "Статус: Confirmed. Проверьте статус: /status"
+            )
+        else:
+            text = (
+                f"🧾 Заказ #{order_id} создан, оплата (эмуляция) отклонена.\n"
+                "Повторить оплату: /pay"
+            )
+        bot.edit_message_text(text, chat_id, message_id)
+        bot.answer_callback_query(c.id)
+
+
+@bot.message_handler(commands=["history"])
+def cmd_history(m):
+    """
+    /history — последние заказы; /history <курсор> — следующая страница.
+    """
+    parts = m.text.split()
+    before = None
+    if len(parts) > 1:
+        before = decode_history_cursor(parts[1])
+        if before is None:
+            bot.reply_to(m, "Неверный курсор. Начните сначала: /history")
+            return
+    uid = str(m.from_user.id)
+    orders = db.list_orders(uid, HISTORY_PAGE_SIZE, before)
+    if not orders:
+        bot.reply_to(m, "Больше заказов нет." if before else "У вас ещё нет заказов.")
+        return
+    lines = [
+        f"#{o['id']} — {time.strftime('%d.%m.%Y %H:%M', time.localtime(o['created_at']))}"
+        f" — {format_rub(o['total'])} — {o['status']} (store:{o['store_id']})"
+        for o in orders
+    ]
+    text = "📜 Ваши заказы:\n" + "\n".join(lines)
+    if len(orders) == HISTORY_PAGE_SIZE:
+        text += f"\n\nДальше: /history {encode_history_cursor(orders[-1])}"
+    bot.reply_to(m, text)
+
+
+@bot.message_handler(commands=["export"])
+def cmd_export(m):
+    """
+    /export [csv|jsonl] — выгрузка всех заказов (только для администраторов).
+    """
+    uid = str(m.from_user.id)
+    if uid not in ADMIN_IDS:
+        bot.reply_to(m, "Команда доступна только администраторам.")
+        return
+    parts = m.text.split()
+    fmt = parts[1].lower() if len(parts) > 1 else "csv"
+    if fmt not in EXPORT_FORMATS:
+        bot.reply_to(m, "Использование: /export [csv|jsonl]")
+        return
+    if not _export_lock.acquire(blocking=False):
+        bot.reply_to(m, "Выгрузка уже идёт, дождитесь файла.")
+        return
+    # выгрузка большой базы идёт минутами — не держим поток хендлеров
+    threading.Thread(
+        target=run_export, args=(m.chat.id, fmt), name="export", daemon=True
+    ).start()
+    bot.reply_to(m, "Выгрузка запущена, пришлю файл, когда будет готов.")
+
+
+@bot.message_handler(commands=["backup"])
+def cmd_backup(m):
+    """
+    /backup — снять бэкап app.db прямо сейчас (только для администраторов).
+    """
+    uid = str(m.from_user.id)
+    if uid not in ADMIN_IDS:
+        bot.reply_to(m, "Команда доступна только администраторам.")
+        return
+    chat_id = m.chat.id
+
+    def done(report, error):
+        if error is not None:
+            bot.send_message(chat_id, f"Бэкап не удался: {error}")
+            return
+        before, during = report["latency_before"], report["latency_during"]
+        bot.send_message(
+            chat_id,
+            f"💾 Бэкап готов: {os.path.basename(report['path'])}\n"
+            f"Время: {report['seconds']} с, шагов: {report['steps']}\n"
+            f"Строк: {report['rows']}\n"
+            f"Хендлеры до: p95 {before['p95']} мс (n={before['n']}), "
+            f"во время: p95 {during['p95']} мс (n={during['n']})",
+        )
+
+    # бэкап снимает поток бэкапов, хендлер не ждёт его минутами
+    backups.request(done)
+    bot.reply_to(m, "Бэкап запущен, пришлю отчёт, когда будет готов.")
+
+
 @bot.message_handler(commands=["cancel"])
 def cmd_cancel(m):
     uid = str(m.from_user.id)
-    db.clear_cart(uid)
+    carts.clear_cart(uid)
     bot.reply_to(m, "🗑 Корзина очищена.")
 
 
 # ===== Запуск =====
 if __name__ == "__main__":
+    # python telegram_bot.py export <csv|jsonl> <файл> — выгрузка без запуска бота
+    if len(sys.argv) == 4 and sys.argv[1] == "export" and sys.argv[2] in EXPORT_FORMATS:
+        print(f"Exported {export_orders(sys.argv[3], sys.argv[2])} orders")
+        sys.exit(0)
+    # python telegram_bot.py restore <файл бэкапа> — восстановление app.db
+    if len(sys.argv) == 3 and sys.argv[1] == "restore":
+        restore_backup(sys.argv[2], DB_PATH)
+        print(f"Restored {DB_PATH} from {sys.argv[2]}")
+        sys.exit(0)
+    if BACKUP_INTERVAL_S > 0:
+        backups.start(BACKUP_INTERVAL_S)
     print("PizzaFlow bot is running...")
     bot.infinity_polling(skip_pending=True)